@@ -1,59 +1,91 @@
-import requests
 import argparse
 import os
-import time
+import threading
+from collections import defaultdict, deque
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 from bs4 import BeautifulSoup
-from pdf2image import convert_from_path
+from rtk import utils
+from rtk.sessions import SessionPool, RateLimiter
+from rtk.rasterize import PDFRasterizer
+from rtk.task import DownloadIIIFImageTask
+
+# one pooled and rate limited session per host, set by configure()
+SESSIONS = SessionPool()
+# number of pages downloaded at the same time for a book
+PAGES_IN_FLIGHT = 4
+# number of processes rendering the pages of a PDF
+PDF_WORKERS = 1
+
+
+def configure(books_per_host, pages_per_book, rate, pdf_workers=1):
+    global SESSIONS, PAGES_IN_FLIGHT, PDF_WORKERS
+    PAGES_IN_FLIGHT = pages_per_book
+    PDF_WORKERS = pdf_workers
+    SESSIONS = SessionPool(connections=books_per_host * pages_per_book, limiter=RateLimiter(rate=rate))
+    # image downloads of rtk share the connections and rate limits of the script
+    utils.SESSIONS = SESSIONS
+
+
+def prefetch(fetch, first=1):
+    # yields fetch(first), fetch(first+1)... in order, with PAGES_IN_FLIGHT pages downloaded ahead
+    # the caller stops iterating at the end of the book, pages fetched ahead are then dropped
+    with ThreadPoolExecutor(max_workers=PAGES_IN_FLIGHT) as executor:
+        futures = deque(executor.submit(fetch, i) for i in range(first, first + PAGES_IN_FLIGHT))
+        next_page = first + PAGES_IN_FLIGHT
+        try:
+            while True:
+                yield futures.popleft().result()
+                futures.append(executor.submit(fetch, next_page))
+                next_page += 1
+        finally:
+            for future in futures:
+                future.cancel()
+
 
 def download_one_page(url):
-    # try to download the image 10 times before returning the error code
-    image = requests.get(url)
-    tried = 1
-    time_to_wait = 40
-    while image.status_code != 200:
-        image = requests.get(url)
-        tried += 1
-        if image.status_code != 200:
-            if tried == 10:
-                return (image.status_code, None)
-            print("HTTP code " + str(image.status_code) + " while downloading " + url + ". Retrying in " + str(time_to_wait) + " seconds...")
-            time_to_wait += 10
-            time.sleep(time_to_wait)
+    # SESSIONS retries overloaded servers with backoff (or the delay they ask for), below the rate of the library
+    image = SESSIONS.get(url)
+    if image.status_code != 200:
+        print("HTTP code " + str(image.status_code) + " while downloading " + url)
+        return (image.status_code, None)
     return 200, image
 
 
+def gallica_manifest_url(url):
+    # https://gallica.bnf.fr/ark:/12148/bpt6k1280591d -> https://gallica.bnf.fr/iiif/ark:/12148/bpt6k1280591d/manifest.json
+    return url.replace("/ark:/", "/iiif/ark:/", 1) + "/manifest.json"
+
+
+def gallica_page_count(url):
+    response = SESSIONS.get(gallica_manifest_url(url))
+    if response.status_code != 200:
+        return response.status_code, 0
+    manifest = response.json()
+    return 200, len(manifest["sequences"][0]["canvases"])
+
+
 def download_gallica(output_folder, url):
     book_name = url.split('/')[-1]
     try:
         os.mkdir(output_folder + '/' + book_name)
     except FileExistsError:
         print("Folder " + output_folder + '/' + book_name + " already exists.")
-    cpt_pages = 1
-    current_url = url+"/f"+str(cpt_pages)+".highres"
-    print("Downloading " + current_url + "...")
-    http_code, image = download_one_page(current_url)
+    # the manifest gives the number of pages: they are downloaded in parallel, pages already downloaded are skipped
+    http_code, nb_pages = gallica_page_count(url)
     if(http_code != 200):
+        print("HTTP code " + str(http_code) + " while downloading the manifest of " + url)
         return http_code
-    new_url = url+"/f"+str(cpt_pages+1)+".highres"
-    print("Downloading " + new_url + "...")
-    http_code, new_image = download_one_page(new_url)
-    if(http_code != 200):
-        return http_code
-    # no proper error code, must download until content stay the same
-    while image.content != new_image.content:
-        output_filename = output_folder + '/' + book_name + '/' + str(cpt_pages) + '.jpg'
-        with open(output_filename, 'wb') as f:
-            f.write(image.content)
-        cpt_pages += 1
-        image = new_image
-        new_url = url+"/f"+str(cpt_pages+1)+".highres"
-        print("Downloading " + new_url + "...")
-        http_code, new_image = download_one_page(new_url)
-        if(http_code != 200):
-            return http_code
-    output_filename = output_folder + '/' + book_name + '/' + str(cpt_pages) + '.jpg'
-    with open(output_filename, 'wb') as f:
-            f.write(image.content)
+    pages = [
+        (url+"/f"+str(cpt_pages)+".highres", output_folder + '/' + book_name, str(cpt_pages))
+        for cpt_pages in range(1, nb_pages+1)
+    ]
+    task = DownloadIIIFImageTask(pages, multiprocess=PAGES_IN_FLIGHT)
+    task.process()
+    missing = [page for page in pages if not os.path.exists(task.rename_download(page))]
+    if missing:
+        print("Failed to download " + str(len(missing)) + " pages out of " + str(nb_pages) + " from " + url)
+        return 0
     return 200
 
 def reformat_erara_url(url):
@@ -66,7 +98,7 @@ def reformat_erara_url(url):
 
 def download_erara(output_folder, url):
     print(url)
-    response = requests.get(url)
+    response = SESSIONS.get(url)
     if response.status_code != 200:
         print("Error code "+str(response.status_code)+" while downloading "+url)
         return response.status_code
@@ -78,7 +110,7 @@ def download_erara(output_folder, url):
         return 0
     i3f_manifest_url = "https://www.e-rara.ch"+links[0]
     print("manifest url: "+i3f_manifest_url)
-    response = requests.get(i3f_manifest_url)
+    response = SESSIONS.get(i3f_manifest_url)
     if response.status_code != 200:
         print("Error code "+str(response.status_code)+" while downloading "+url)
         return response.status_code
@@ -95,9 +127,9 @@ def download_erara(output_folder, url):
         os.mkdir(book_folder)
     except FileExistsError:
         print("Folder " + book_folder + " already exists.")
-    for i, img_url in enumerate(images):
+
+    def download_image(i, img_url):
         print("Downloading "+img_url+" from "+url)
-        #img_response = requests.get(img_url, stream=True)
         status_code, img_response = download_one_page(img_url)
         if status_code == 200:
             img_path = os.path.join(book_folder, f"{i+1}.jpg")
@@ -106,66 +138,127 @@ def download_erara(output_folder, url):
                     file.write(chunk)
         else:
             print(f"Failed to download {img_url}, error code {status_code}")
-            return status_code
+        return status_code
+
+    with ThreadPoolExecutor(max_workers=PAGES_IN_FLIGHT) as executor:
+        for status_code in executor.map(download_image, range(len(images)), images):
+            if status_code != 200:
+                executor.shutdown(cancel_futures=True)
+                return status_code
 
     return 200
 
-def numelyo_title_contains_404(image):
+# page url patterns of numelyo, the first one serving the first page of a book is used for all its pages
+NUMELYO_FORMATS = ["web_TIF", "web_JPG"]
+
+
+def numelyo_page_url(base_url, fmt, i):
+    return base_url+f"/{fmt}{i:08d}.jpg"
+
+
+def numelyo_is_html(response):
+    return response.headers.get("Content-Type", "").startswith("text/html")
+
+
+def numelyo_title_contains_404(response):
     try:
-        soup = BeautifulSoup(image.text, "html.parser")
+        soup = BeautifulSoup(response.text, "html.parser")
         title = soup.title.string if soup.title else ""
         return "404 Not Found" in title
-    except Exception as e:
-        # yeah ... probably an image ...
+    except Exception:
         return False
 
 
-def download_one_page_numelyo(base_url, i):
-    # try TIF format
-    url = base_url+f"/web_TIF{i:08d}.jpg"
-    image = requests.get(url)
-    if not numelyo_title_contains_404(image):
-        if image.status_code == 200:
-            print(url)
-            return 200, image
-        # image exist, but timeout or other, retry
-        return download_one_page(url)
-    # not TIF, try JPG
-    url = base_url+f"/web_JPG{i:08d}.jpg"
-    image = requests.get(url)
-    if not numelyo_title_contains_404(image):
-        if image.status_code == 200:
-            print(url)
-            return 200, image
-        # image exist, but timeout or other, retry
-        return download_one_page(url)
+def numelyo_page_status(response):
+    # 200 for an image (any body that is not HTML), 404 for a missing page (a 404 or the HTML "404 Not Found"
+    # page), the HTTP code of any other failure
+    if response.status_code == 404:
+        return 404
+    if response.status_code not in (200, 206):
+        return response.status_code
+    if not numelyo_is_html(response):
+        return 200
+    if numelyo_title_contains_404(response):
+        return 404
+    # an HTML page which is neither the image nor the missing page
+    return 502
+
+
+def numelyo_probe(url):
+    response = SESSIONS.head(url, allow_redirects=True)
+    if response.status_code in (405, 501):
+        # HEAD not supported, only ask for the first byte
+        with SESSIONS.get(url, headers={"Range": "bytes=0-0"}, stream=True) as response:
+            if not (response.status_code in (200, 206) and numelyo_is_html(response)):
+                return numelyo_page_status(response)
+    elif not (response.status_code in (200, 206) and numelyo_is_html(response)):
+        return numelyo_page_status(response)
+    # an HTML page: its title tells whether the page is missing
+    return numelyo_page_status(SESSIONS.get(url))
+
+
+def numelyo_page_format(base_url, i=1, formats=NUMELYO_FORMATS):
+    # (200, format) of the first format serving page [i], (404, None) if none does, (error code, None) on a failure
+    for fmt in formats:
+        status_code = numelyo_probe(numelyo_page_url(base_url, fmt, i))
+        if status_code == 200:
+            return 200, fmt
+        if status_code != 404:
+            return status_code, None
     return 404, None
 
 
+def download_one_page_numelyo(base_url, fmt, i):
+    url = numelyo_page_url(base_url, fmt, i)
+    image = SESSIONS.get(url)
+    status_code = numelyo_page_status(image)
+    if status_code == 200:
+        print(url)
+        return 200, image
+    if status_code == 404:
+        # end of the book, unless this page uses another format
+        status_code, other_fmt = numelyo_page_format(base_url, i, [other for other in NUMELYO_FORMATS if other != fmt])
+        if other_fmt is None:
+            return status_code, None
+        return download_one_page_numelyo(base_url, other_fmt, i)
+    return status_code, None
+
+
 def download_numelyo(output_folder, url):
     base_url = url.replace("f_view", "f_eserv")
-    status_code = 200
     i = 1
     book_folder = output_folder+"/numelyo_"+url.split("/")[4].split(":")[0]+"_"+url.split("/")[4].split(":")[1]
     try:
         os.mkdir(book_folder)
     except FileExistsError:
         print("Folder " + book_folder + " already exists.")
-    while status_code != 404:
+    # the format of the pages is found once per book
+    status_code, fmt = numelyo_page_format(base_url)
+    if status_code == 404:
+        print(f"Done downloading 0 pages")
+        return 200
+    if fmt is None:
+        print(f"Failed to find the page format of {base_url}, error code {status_code}")
+        return status_code
+
+    def fetch(i):
         print(f"Downloading {base_url} page {i}")
-        status_code, img_response = download_one_page_numelyo(base_url, i)
-        if status_code==404:
-            print(f"Done downloading {i-1} pages")
-            return 200
-        if status_code == 200:
-            img_path = os.path.join(book_folder, f"{i}.jpg")
-            with open(img_path, "wb") as file:
-                for chunk in img_response.iter_content(1024):
-                    file.write(chunk)
-        else:
-            print(f"Failed to download {img_url}, error code {status_code}")
-            return status_code
-        i += 1
+        return download_one_page_numelyo(base_url, fmt, i)
+
+    with closing(prefetch(fetch)) as pages:
+        for status_code, img_response in pages:
+            if status_code==404:
+                print(f"Done downloading {i-1} pages")
+                return 200
+            if status_code == 200:
+                img_path = os.path.join(book_folder, f"{i}.jpg")
+                with open(img_path, "wb") as file:
+                    for chunk in img_response.iter_content(1024):
+                        file.write(chunk)
+            else:
+                print(f"Failed to download {base_url} page {i}, error code {status_code}")
+                return status_code
+            i += 1
     return None
 
 def download_tolosana(output_folder, url):
@@ -173,26 +266,36 @@ def download_tolosana(output_folder, url):
     book_folder = output_folder+f"/tolosana_"+book_number+"/"
     pdf_url = "https://documents.univ-toulouse.fr/150NDG/PPN"+book_number+".pdf"
     print("Downloading "+pdf_url)
-    status_code, pdf = download_one_page(pdf_url)
-    if status_code!=200:
-        return status_code
     try:
         os.mkdir(book_folder)
     except FileExistsError:
         print("Folder " + book_folder + " already exists.")
     pdf_path = book_folder+"/"+book_number+".pdf"
-    with open(pdf_path, "wb") as file:
-        for chunk in pdf.iter_content(1024):
-            file.write(chunk)
-    images = convert_from_path(pdf_path, dpi=300)
-    for i, image in enumerate(images):
-        print(f"Converting page {i} from tolosana book {book_number}")
-        image.save(book_folder+f"/{i+1}.jpg", "JPEG")
+    # streamed to disk (the PDF is never held in memory), an interrupted download is resumed
+    result = utils.download(pdf_url, pdf_path)
+    if not result:
+        return result.status or 0
+    # pages are rendered by PDF_WORKERS processes and written one by one, as 1.jpg, 2.jpg...
+    print(f"Converting pages from tolosana book {book_number}")
+    PDFRasterizer(dpi=300, quality=75, workers=PDF_WORKERS).extract(pdf_path, book_folder+"/{}.jpg", numbering_start=1)
     os.remove(pdf_path)
     return 200
     
 
-def download_books(output_folder, urls):
+def book_downloader(url):
+    # returns the function downloading the book at url (one per library) and the url to give it
+    if "gallica.bnf.fr" in url:
+        return download_gallica, url
+    elif "doi" in url and "e-rara" in url:
+        return download_erara, reformat_erara_url(url)
+    elif "https://numelyo.bm-lyon.fr" in url:
+        return download_numelyo, url
+    elif "https://tolosana.univ-toulouse.fr" in url:
+        return download_tolosana, url
+    return None, url
+
+
+def download_books(output_folder, urls, books_per_host=2):
     number_of_try = 2
     for i in range(number_of_try):
         try:
@@ -207,43 +310,44 @@ def download_books(output_folder, urls):
             except FileNotFoundError:
                 print("No previously downloaded books.")
             print("Remaining books to download: " + str(len(urls)))
-            cpt_books = 0
+            # libraries are different hosts: they are downloaded at the same time, books_per_host books each
+            books_by_host = defaultdict(list)
             for url in urls:
-                if "gallica.bnf.fr" in url:
-                    ret_code = download_gallica(output_folder, url)
-                    if ret_code != 200:
-                        return ret_code
-                    cpt_books += 1
-                    print("=== Downloaded " + str(cpt_books) + " books out of " + str(len(urls)) + " ===")
-                    with open("downloaded_books.txt", "a") as file:
-                        file.write(url+"\n")
-                elif "doi" in url and "e-rara" in url:
-                    proper_url = reformat_erara_url(url)
-                    ret_code = download_erara(output_folder, proper_url)
-                    if ret_code != 200:
-                        return ret_code
-                    cpt_books += 1
-                    print("=== Downloaded " + str(cpt_books) + " books out of " + str(len(urls)) + " ===")
-                    with open("downloaded_books.txt", "a") as file:
-                        file.write(url+"\n")
-                elif "https://numelyo.bm-lyon.fr" in url:
-                    ret_code = download_numelyo(output_folder, url)
-                    if ret_code != 200:
-                        return ret_code
-                    cpt_books += 1
-                    print("=== Downloaded " + str(cpt_books) + " books out of " + str(len(urls)) + " ===")
-                    with open("downloaded_books.txt", "a") as file:
-                        file.write(url+"\n")
-                elif "https://tolosana.univ-toulouse.fr" in url:
-                    ret_code = download_tolosana(output_folder, url)
+                download, proper_url = book_downloader(url)
+                if download is None:
+                    print("(unable to download) book url : "+url)
+                else:
+                    books_by_host[download].append((url, proper_url))
+            cpt_books = 0
+            error_codes = []
+            lock = threading.Lock()
+
+            def download_book(download, url, proper_url):
+                nonlocal cpt_books
+                if error_codes:
+                    return
+                ret_code = download(output_folder, proper_url)
+                with lock:
                     if ret_code != 200:
-                        return ret_code
+                        error_codes.append(ret_code)
+                        return
                     cpt_books += 1
                     print("=== Downloaded " + str(cpt_books) + " books out of " + str(len(urls)) + " ===")
                     with open("downloaded_books.txt", "a") as file:
                         file.write(url+"\n")
-                else:
-                    print("(unable to download) book url : "+url)
+
+            executors = [ThreadPoolExecutor(max_workers=books_per_host) for _ in books_by_host]
+            futures = [
+                executor.submit(download_book, download, url, proper_url)
+                for executor, (download, books) in zip(executors, books_by_host.items())
+                for url, proper_url in books
+            ]
+            for executor in executors:
+                executor.shutdown()
+            for future in futures:
+                future.result()
+            if error_codes:
+                return error_codes[0]
         except Exception as e:
             print("Error while downloading books: " + str(e))
             print("Try number " + str(i))
@@ -264,7 +368,16 @@ parser.add_argument('output', metavar='OUT', type=str,
                     help='folder where files are stored')
 parser.add_argument('column', metavar='COL', type=int, 
                     help='index of column containing URL in metadata file')
+parser.add_argument('--books-per-host', type=int, default=2,
+                    help='number of books downloaded at the same time from each library (default: 2)')
+parser.add_argument('--pages-per-book', type=int, default=4,
+                    help='number of pages downloaded at the same time for each book (default: 4)')
+parser.add_argument('--rate', type=float, default=5,
+                    help='maximum number of requests per second sent to each library (default: 5)')
+parser.add_argument('--pdf-workers', type=int, default=os.cpu_count(),
+                    help='number of processes rendering the pages of a PDF (default: number of CPUs)')
 args = parser.parse_args()
+configure(args.books_per_host, args.pages_per_book, args.rate, args.pdf_workers)
 
 urls = get_books_urls(args.input, args.column)
 
@@ -273,7 +386,7 @@ try:
 except FileExistsError:
     print("Folder " + args.output + " already exists.")
 
-ret = download_books(args.output, urls)
+ret = download_books(args.output, urls, args.books_per_host)
 
 if ret != 200:
     print("HTTP code " + str(ret) + " returned.")
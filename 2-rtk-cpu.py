@@ -6,13 +6,15 @@ It takes a file with a list of manifests to download from IIIF (See manifests.tx
 0. It downloads manifests and transform them into CSV files
 1. It downloads images from the manifests
 2. It applies YALTAi segmentation with line segmentation
-3. It fixes up the image PATH of XML files
+3. It fixes up the image PATH of XML files and counts their lines
 4. It processes the text as well through Kraken
 5. It removes the image files (from the one hunder object that were meant to be done in group)
 
 The batch file should be lower if you want to keep the space used low, specifically if you use DownloadIIIFManifest.
 """
-from rtk.task import KrakenAltoCleanUpCommand, YALTAiCommand, KrakenRecognizerCommand
+from rtk.task import AltoPostProcessCommand, YALTAiCommand, KrakenRecognizerCommand
+from rtk.pipeline import StreamingPipeline
+from rtk.ledger import Ledger
 import glob
 import time
 import argparse
@@ -25,6 +27,10 @@ parser.add_argument('batch', metavar='BATCH', type=str, help='batch index')
 parser.add_argument('kraken_model', metavar='KMDL', type=str, help='kraken model')
 parser.add_argument('yolo_model', metavar='YMDL', type=str, help='yolo model')
 parser.add_argument('line_model', metavar='LMDL', type=str, help='line model')
+parser.add_argument('--engine', action='store_true', help='load the models once per worker instead of spawning the CLIs')
+parser.add_argument('--stream', action='store_true', help='send each page to post-processing and OCR as soon as it is segmented')
+parser.add_argument('--ledger', action='store_true', help='record processed pages in BASEBATCH-ledger.sqlite for faster resume')
+parser.add_argument('--trust-ledger', action='store_true', help='do not stat the outputs recorded in the ledger on resume')
 args = parser.parse_args()
 
 nb_process = 10
@@ -37,20 +43,15 @@ print("kraken model : "      + args.kraken_model)
 print("yolo model : "        + args.yolo_model)
 print("line model : "        + args.line_model)
 print("number of process : " + str(nb_process))
+print("engine mode : "       + str(args.engine))
+print("stream mode : "       + str(args.stream))
+print("ledger : "            + str(args.ledger))
 folders = glob.glob(args.base + args.batch + "/*")
+ledger = Ledger(f"{args.base}{args.batch}-ledger.sqlite", verify=not args.trust_ledger) if args.ledger else None
 
 
-for i in range(0, len(folders), books_per_batch):
-    #print("processing folders ", folders[i], folders[i+1], folders[i+2], folders[i+3])
-    batch = [
-        file
-        for folder in folders[i:i+books_per_batch]
-        for file in glob.glob(f"{folder}/*.jpg")
-    ]
-    startYalt = time.time()
-    # Apply YALTAi
-    print("[Task] Segment, size of batch ", len(batch))
-    yaltai = YALTAiCommand(
+def segmenter(batch, multiprocess):
+    return YALTAiCommand(
         batch,
         binary=".venv/bin/yaltai",
         device=device,
@@ -58,34 +59,78 @@ for i in range(0, len(folders), books_per_batch):
         verbose=True,
         raise_on_error=False,
         allow_failure=False,
-        multiprocess=nb_process,
+        multiprocess=multiprocess,
         check_content=False,
-        line_model=args.line_model
+        line_model=args.line_model,
+        engine=args.engine,
+        quarantine=f"{args.base}{args.batch}-quarantine-segment.txt",
+        ledger=ledger
     )
-    yaltai.process()
-    endYalt = time.time()
-    print("[Time] Yaltai: ", endYalt - startYalt)
-    print("Yaltai output files len ", len(yaltai.output_files)) 
-    
-    # Clean-up the relative filepath of Kraken Serialization
-    print("[Task] Clean-Up Serialization")
-    cleanup = KrakenAltoCleanUpCommand(yaltai.output_files)
-    cleanup.process()
-    
-    startKrak = time.time()
-    # Apply Kraken
-    print("[Task] OCR")
-    kraken = KrakenRecognizerCommand(
-        yaltai.output_files,
+
+
+def recognizer(batch, multiprocess):
+    return KrakenRecognizerCommand(
+        batch,
         binary=".venv/bin/kraken",
         device=device,
         model=args.kraken_model,
-        multiprocess=nb_process,
-        check_content=True  # TODO: was written "Required ?", but I see False in the example-manifest.py
+        multiprocess=multiprocess,
+        check_content=True,  # TODO: was written "Required ?", but I see False in the example-manifest.py
+        engine=args.engine,
+        quarantine=f"{args.base}{args.batch}-quarantine-ocr.txt",
+        content_stage="AltoPostProcessCommand",  # Lines counted by the post-processing, read from the ledger
+        ledger=ledger
     )
-    kraken.process()
-    endKrak = time.time()
-    print("[Time] Kraken: ", endKrak - startKrak)
+
+
+if args.stream:
+    # No group barrier: segmentation and OCR share the cores, pages flow through bounded queues
+    batch = [
+        file
+        for folder in folders
+        for file in glob.glob(f"{folder}/*.jpg")
+    ]
+    print("[Task] Segment, Post-Process Serialization and OCR, size of batch ", len(batch))
+    seg_process = max(1, nb_process // 2)
+    yaltai = segmenter(batch, seg_process)
+    segmented = [yaltai.rename(file) for file in batch]
+    StreamingPipeline(
+        [
+            yaltai,
+            AltoPostProcessCommand(segmented, ledger=ledger),
+            recognizer(segmented, max(1, nb_process - seg_process))
+        ],
+        queue_size=nb_process * 2
+    ).run()
+else:
+    for i in range(0, len(folders), books_per_batch):
+        #print("processing folders ", folders[i], folders[i+1], folders[i+2], folders[i+3])
+        batch = [
+            file
+            for folder in folders[i:i+books_per_batch]
+            for file in glob.glob(f"{folder}/*.jpg")
+        ]
+        startYalt = time.time()
+        # Apply YALTAi
+        print("[Task] Segment, size of batch ", len(batch))
+        yaltai = segmenter(batch, nb_process)
+        yaltai.process()
+        endYalt = time.time()
+        print("[Time] Yaltai: ", endYalt - startYalt)
+        print("Yaltai output files len ", len(yaltai.output_files)) 
+    
+        # Clean-up the relative filepath of Kraken Serialization and count the lines
+        print("[Task] Post-Process Serialization")
+        postprocess = AltoPostProcessCommand(yaltai.output_files, ledger=ledger)
+        postprocess.process()
+    
+        startKrak = time.time()
+        # Apply Kraken
+        print("[Task] OCR")
+        kraken = recognizer(yaltai.output_files, nb_process)
+        kraken.process()
+        endKrak = time.time()
+        print("[Time] Kraken: ", endKrak - startKrak)
     
 
 end = time.time()
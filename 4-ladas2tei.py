@@ -4,7 +4,11 @@ from lxml import etree as ET
 from datetime import datetime
 import csv
 import re
+import json
+import hashlib
 from glob import glob
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 
 tei_mapping = {
     "AdvertisementZone": """<fw type="ad">""",
@@ -54,32 +58,162 @@ cumulative = {
     } 
 
 
-def process_document(directory, doc, liste_block, xslt_file, n):
+ALTO_NS = "{http://www.loc.gov/standards/alto/ns-v4#}"
+
+
+def read_alto_zones(xml_file):
+    """
+    Reads the zones of an ALTO file in a single pass, without building the document nor applying the XSLT. The result
+    is the same as the one of alto2XMLsimple.xsl: one zone per TextBlock, labelled by the OtherTag of its TAGREFS,
+    with the lines of all its TextLine, made of the CONTENT of their String and a space for each SP.
+
+    :param xml_file: Path to the ALTO file.
+    :return: List of (zone type, list of line texts), or None in case of error.
+    """
+    labels = {}
+    zones = []
+    open_zones = []
+    try:
+        context = ET.iterparse(
+            xml_file,
+            events=("start", "end"),
+            tag=(ALTO_NS + "TextBlock", ALTO_NS + "TextLine", ALTO_NS + "OtherTag")
+        )
+        for event, element in context:
+            tag = element.tag
+            if tag == ALTO_NS + "TextLine":
+                if event == "end":
+                    text = "".join(
+                        child.get("CONTENT", "") if child.tag == ALTO_NS + "String" else " "
+                        for child in element.iterchildren(ALTO_NS + "String", ALTO_NS + "SP")
+                    ) or None
+                    for zone in open_zones:
+                        zone[1].append(text)
+                    element.clear()
+            elif tag == ALTO_NS + "TextBlock":
+                if event == "start":
+                    zones.append((element.get("TAGREFS"), []))
+                    open_zones.append(zones[-1])
+                else:
+                    open_zones.pop()
+                    element.clear()
+            elif event == "end" and element.get("ID") is not None and element.get("LABEL") is not None:
+                # key() returns every OtherTag with this ID, the first label in document order is used
+                labels.setdefault(element.get("ID"), element.get("LABEL"))
+    except (ET.XMLSyntaxError, OSError) as e:
+        print(f"Error: {e}")
+        return None
+    if context.root.tag != ALTO_NS + "alto":
+        # The XSLT only matches ALTO v4 documents
+        raise ValueError(f"{xml_file} is not an ALTO v4 file")
+    return [(labels.get(tagrefs, "") if tagrefs is not None else "", lines) for tagrefs, lines in zones]
+
+
+def read_zones(xml_file, xslt_file):
     """
-    Processes each document in the directory, applies XSLT, and generates the corresponding TEI structure.
+    Applies the XSLT to an ALTO file and reads its zones.
+
+    :param xml_file: Path to the ALTO file.
+    :param xslt_file: Path to the XSLT file, or None to read the ALTO file directly with read_alto_zones().
+    :return: List of (zone type, list of line texts), or None in case of error.
+    """
+    if xslt_file is None:
+        return read_alto_zones(xml_file)
+    transformed_tree = apply_xslt(xml_file, xslt_file)
+    if not transformed_tree:
+        return None
+    root = transformed_tree.getroot()
+    return [
+        (zone.attrib.get('type', None), [line.text for line in zone.findall("line")])
+        for zone in root.findall('region')
+    ]
+
+
+def process_document(directory, doc, builder, xslt_file, n, cache=None):
+    """
+    Processes each document in the directory, applies XSLT, and adds the corresponding TEI structure to the builder.
     
-    :param doc: The document to be processed.
-    :param xslt_file: Path to the XSLT file.
     :param directory: Directory containing the XML files.
-    :param tei_mapping: Mapping for TEI elements.
-    :param cumulative: Cumulative zones dictionary.
-    """
-    transformed_tree = apply_xslt(directory+'/'+doc, xslt_file)
-    if transformed_tree:
-        root = transformed_tree.getroot()
-        liste_zone = root.findall('region')
-        liste_block.append(f"<pb n='{n}' facs='{doc}'/>")
-        n_zone = 0
-        for zone in liste_zone:
-            zone_type = zone.attrib.get('type', None)
+    :param doc: The document to be processed.
+    :param builder: TEIBuilder of the book.
+    :param xslt_file: Path to the XSLT file, None to read the ALTO files directly.
+    :param n: Page number.
+    :param cache: PageCache of the book, if any.
+    """
+    xml_file = directory+'/'+doc
+    liste_zone = cache.get(xml_file) if cache else None
+    if liste_zone is None:
+        liste_zone = read_zones(xml_file, xslt_file)
+        if liste_zone is not None and cache:
+            cache.put(xml_file, liste_zone)
+    if liste_zone is not None:
+        builder.add_page(n, doc)
+        for n_zone, (zone_type, lines) in enumerate(liste_zone):
             tag = tei_mapping.get(zone_type, '<ab>')
             continued = "Continued" in zone_type if zone_type else False
             cumul = cumulative.get(zone_type, False) if zone_type else False
             is_list = True if isinstance(tag, list) else False
-            liste_line = process_line(zone, tag,n, n_zone)
-            liste_block = update_block(liste_block, tag,liste_line, continued, cumul, is_list, zone_type)
-            n_zone+=1
-    return liste_block
+            liste_line = process_line(lines, n, n_zone)
+            builder.add_zone(tag, liste_line, continued, cumul, is_list, zone_type)
+
+
+class PageCache:
+    """
+    Zones of each page of a book as read by the XSLT, kept between runs in [directory] (one JSON file per page), so
+    that a rebuild only applies the XSLT to the pages which changed. A page is reused when its mtime and size, or else
+    its SHA-1, did not change, and when it was read with the same XSLT.
+
+    :param directory: Cache directory of the book.
+    :param xslt_file: Path to the XSLT file, None when the ALTO files are read directly.
+    """
+    # Bump when the format of the cached zones changes
+    format_version = 1
+
+    def __init__(self, directory, xslt_file):
+        self.directory = directory
+        self.version = f"{self.format_version}-{file_sha1(xslt_file) if xslt_file else 'direct'}"
+        os.makedirs(directory, exist_ok=True)
+
+    def _entry_path(self, xml_file):
+        return os.path.join(self.directory, os.path.basename(xml_file) + ".json")
+
+    def get(self, xml_file):
+        """
+        Returns the cached zones of [xml_file], or None if it changed since.
+        """
+        try:
+            with open(self._entry_path(xml_file), encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("version") != self.version:
+            return None
+        stat = os.stat(xml_file)
+        if (entry["mtime_ns"], entry["size"]) != (stat.st_mtime_ns, stat.st_size):
+            if entry["sha1"] != file_sha1(xml_file):
+                return None
+            # Touched or copied without changes
+            self.put(xml_file, entry["zones"], entry["sha1"])
+        return entry["zones"]
+
+    def put(self, xml_file, zones, sha1=None):
+        stat = os.stat(xml_file)
+        entry = {
+            "version": self.version,
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "sha1": sha1 or file_sha1(xml_file),
+            "zones": zones
+        }
+        write_file(self._entry_path(xml_file), json.dumps(entry, ensure_ascii=False))
+
+
+def file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
 
 
 def fill_header(template_file, metadata):
@@ -92,6 +226,28 @@ def fill_header(template_file, metadata):
         template = template.replace(f'[{placeholder}]', str(value))
     return template
 
+@lru_cache(maxsize=None)
+def get_transform(xslt_file):
+    """
+    Parses and compiles an XSLT file, once per process.
+
+    :param xslt_file: Path to the XSLT file.
+    :return: Compiled XSLT transformation.
+    """
+    return ET.XSLT(ET.parse(xslt_file))
+
+
+def index_directories(directory):
+    """
+    Indexes all the directories below [directory] by their name, walking the tree once.
+
+    :param directory: Root directory.
+    :return: Dictionary of directory name to directory path (the last one found wins on duplicate names).
+    """
+    subdirs = glob(os.path.join(directory, "**/"), recursive = True)
+    return {os.path.basename(os.path.normpath(d)): d for d in subdirs}
+
+
 def apply_xslt(xml_file, xslt_file):
     """
     Parses an XML file and applies an XSLT transformation.
@@ -102,35 +258,31 @@ def apply_xslt(xml_file, xslt_file):
     """
     try:
         xml_tree = ET.parse(xml_file)
-        xslt_tree = ET.parse(xslt_file)
-        transform = ET.XSLT(xslt_tree)
+        transform = get_transform(xslt_file)
         return transform(xml_tree)
     except Exception as e:
         print(f"Error: {e}")
         return None
 
 
-def process_line(zone, tag, n, n_zone):
+def process_line(lines, n, n_zone):
     """
-    Processes each zone in the XML and returns formatted lines.
+    Processes each line of a zone and returns the corresponding events.
     
-    :param zone: The XML zone element.
-    :param tag: Start tag for the zone.
-    :param tag_end: End tag for the zone.
+    :param lines: Texts of the lines of the zone.
     :param n: Page number.
-    :param n_line: Line number.
-    :return: List of lines with corresponding tags.
+    :param n_zone: Zone number.
+    :return: List of <lb/> and text events.
     """
     liste_line = []
     n_line=0
-    for line in zone.findall("line"):
+    for text in lines:
         n_line += 1
-        text = line.text
         if text:
             text = text.replace("&", "et")
-        if tag == "MainZone-Lg":
-            liste_line.append(f"<l><lb n='{n}_{n_zone}_{n_line}'/> {text}</l>")
-        liste_line.append(f"<lb n='{n}_{n_zone}_{n_line}'/> " + (text or ""))
+        line_id = f"{n}_{n_zone}_{n_line}"
+        liste_line.append((EMPTY, f"<lb n='{line_id}'/>", "lb", {"n": line_id}))
+        liste_line.append((TEXT, " " + (text or ""), None, None))
     
     return liste_line
 
@@ -143,116 +295,479 @@ def create_tag_end(tag):
     return tag_end
 
 
+# Events of the TEI body: (kind, raw string, tag name, attributes)
+START, END, EMPTY, TEXT = "start", "end", "empty", "text"
+
 
-def update_block(liste_block, tag, liste_line, continued, cumul, is_list, zone_type):
+@lru_cache(maxsize=None)
+def split_tag(tag):
     """
-    Updates the block list by adding new content based on zone type, continued blocks, and cumulative blocks.
-    
-    :param liste_block: The list of blocks to be updated.
-    :param tag: Start tag for the zone.
-    :param tag_end: End tag for the zone.
-    :param liste_line: List of processed lines.
-    :param continued: Boolean indicating if the block is continued.
-    :param cumul: Boolean indicating if the block is cumulative.
-    :param n: Page number.
-    :param zone_type: Type of the zone.
-    :return: Updated list of blocks.
-    """
-    #if '<div type="titlepage">' in liste_block[-1] or '<div type="toc">' in liste_block[-1]:
-    #liste_block.append("<div>")
-    if continued:
-        for i in range(len(liste_block)-1, -1, -1):
-            last_block_zone = liste_block[i]
-            if 'fw' in last_block_zone or 'pb' in last_block_zone:
+    Splits a start tag of the TEI mapping into its name and attributes.
+
+    :param tag: Start tag, e.g. '<fw type="ad">'.
+    :return: Tag name and dictionary of attributes.
+    """
+    name, attributes = re.match(r'<(\w+)(.*)>', tag).groups()
+    return name, dict(re.findall(r'(\w+)="([^"]*)"', attributes))
+
+
+@lru_cache(maxsize=None)
+def tag_events(tags):
+    """
+    Start and end events of a tuple of nested tags of the TEI mapping.
+
+    :param tags: Tuple of start tags, outermost first.
+    :return: Tuple of start events and tuple of end events.
+    """
+    starts = tuple((START, tag, *split_tag(tag)) for tag in tags)
+    ends = tuple((END, create_tag_end(tag), split_tag(tag)[0], None) for tag in reversed(tags))
+    return starts, ends
+
+
+def start_events(tag):
+    return tag_events(tuple(tag) if isinstance(tag, list) else (tag, ))[0]
+
+
+def end_events(tag):
+    return tag_events(tuple(tag) if isinstance(tag, list) else (tag, ))[1]
+
+
+class Block:
+    """
+    Events added by one zone or one page break. [skip] marks the blocks whose raw string contains 'fw' or 'pb',
+    which "Continued" zones jump over.
+    """
+    __slots__ = ("events", "skip", "ends")
+
+    def __init__(self, events):
+        self.events = []
+        self.skip = False
+        self.ends = {}
+        self.extend(events)
+
+    def extend(self, events):
+        self.events += events
+        for event in events:
+            raw = event[1]
+            if event[0] == END:
+                self.ends[raw] = self.ends.get(raw, 0) + 1
+            if not self.skip and ('fw' in raw or 'pb' in raw):
+                self.skip = True
+
+    def last_end(self):
+        if self.events and self.events[-1][0] == END:
+            return self.events[-1][1]
+        return None
+
+    def pop_ends(self, raw=None):
+        """
+        Removes the end events of the block, or only those matching [raw].
+
+        :return: Removed events, in order.
+        """
+        if raw is None:
+            removed = [event for event in self.events if event[0] == END]
+            self.events = [event for event in self.events if event[0] != END]
+            self.ends.clear()
+            return removed
+        removed = []
+        i = len(self.events) - 1
+        # Nearly always the last event, the count avoids walking back through long lists
+        while self.ends.get(raw) and i >= 0:
+            if self.events[i][0] == END and self.events[i][1] == raw:
+                removed.insert(0, self.events.pop(i))
+                self.ends[raw] -= 1
+            i -= 1
+        return removed
+
+    def raw(self):
+        return "".join(event[1] for event in self.events)
+
+
+class TEIBuilder:
+    """
+    Builds the <text> of a book zone by zone. Each zone adds a block of events, and a block is sent to [target]
+    through an explicit stack of open elements as soon as no later zone can modify it. Only the last block, and the
+    last one which neither contains 'fw' nor 'pb', can still be modified: a "Continued" zone re-opens the latter and
+    closes its elements after its own lines, a list-like zone (entries, items...) is merged into the former.
+
+    :param target: Receives the events of final blocks, lxml.etree.TreeBuilder by default.
+    :param keep_raw: Keeps the raw string of final blocks for raw_string(), which then covers the whole book.
+    """
+    def __init__(self, target=None, keep_raw=True):
+        self.target = target if target is not None else ET.TreeBuilder()
+        self.pending = [Block(start_events(["<text>", "<body>", "<div>"]))]
+        self.keep_raw = keep_raw
+        self.raw = []
+        self.stack = []
+        self.error = None
+        self.has_head = False
+        self.root_closed = False
+
+    def add_page(self, n, doc):
+        self._append([(EMPTY, f"<pb n='{n}' facs='{doc}'/>", "pb", {"n": str(n), "facs": doc})])
+
+    def add_zone(self, tag, liste_line, continued, cumul, is_list, zone_type):
+        """
+        Adds a zone to the book.
+        
+        :param tag: Start tag(s) for the zone.
+        :param liste_line: Events of the lines of the zone.
+        :param continued: Boolean indicating if the block is continued.
+        :param cumul: Boolean indicating if the block is cumulative.
+        :param is_list: Boolean indicating if the tag is a list of nested tags.
+        :param zone_type: Type of the zone.
+        """
+        if continued:
+            # pending[0] never contains 'fw' or 'pb'
+            block = next(block for block in reversed(self.pending) if not block.skip)
+            last_tag_end = block.pop_ends()
+            if last_tag_end:
+                self._append(liste_line + last_tag_end)
+            else:
+                print('pas de matches')
+            return
+
+        if cumul or is_list:
+            last_block = self.pending[-1]
+            if cumul:
+                # A start tag is compared with an end tag: cumulative zones always open a new block
+                last_tag_needed = tei_mapping[cumulative[zone_type]]
+            else:
+                last_tag_needed = create_tag_end(tag[0])
+            if last_block.last_end() == last_tag_needed:
+                if is_list:
+                    tag = tag[1]
+                last_tag = last_block.pop_ends(last_tag_needed)[-1:]
+                last_block.extend([*start_events(tag), *liste_line, *end_events(tag), *last_tag])
+            else:
+                self._append([*start_events(tag), *liste_line, *end_events(tag)])
+        elif zone_type=="MainZone-Head" and self.has_head:
+            self._append([*end_events("<div>"), *start_events("<div>"), *start_events(tag), *liste_line, *end_events(tag)])
+        else:
+            self._append([*start_events(tag), *liste_line, *end_events(tag)])
+        # Lists of tags never contain <head>
+        self.has_head = self.has_head or tag == "<head>"
+
+    def close(self):
+        """
+        Closes the book and returns the result of the target.
+
+        :raise ValueError: if the blocks do not nest properly.
+        """
+        self._append(list(end_events(["<text>", "<body>", "<div>"])))
+        self._flush(len(self.pending))
+        if self.error is None and self.stack:
+            self.error = ValueError(f"Premature end of data in tag {self.stack[-1]}")
+        if self.error is not None:
+            raise self.error
+        return self.target.close()
+
+    def raw_string(self):
+        """
+        Returns the TEI body as a string, including the blocks which did not nest properly.
+        """
+        return "".join(self.raw) + "".join(block.raw() for block in self.pending)
+
+    def _append(self, events):
+        # The previous last block can no longer be extended: if it is not skipped by "Continued" zones, no block
+        # before it will be modified again.
+        if not self.pending[-1].skip:
+            self._flush(len(self.pending) - 1)
+        self.pending.append(Block(events))
+
+    def _flush(self, count):
+        for block in self.pending[:count]:
+            if self.keep_raw:
+                self.raw.append(block.raw())
+            if self.error is None:
+                try:
+                    self._feed(block.events)
+                except Exception as e:
+                    self.error = e
+        del self.pending[:count]
+
+    def _feed(self, events):
+        target, stack = self.target, self.stack
+        for kind, raw, name, value in events:
+            if self.root_closed:
+                raise ValueError("Extra content at the end of the document")
+            if kind == TEXT:
+                target.data(raw)
                 continue
-            break
-        pattern = r"<\/[^>]+>"
-        matches = re.findall(pattern, last_block_zone)
-        if matches:
-            last_tag_end = ''.join(matches)
-            modified_last_block_zone = re.sub(pattern, '', last_block_zone)
-            liste_block[i] = modified_last_block_zone
-            liste_block.append("".join(liste_line) + last_tag_end)
+            if kind != END:
+                target.start(name, value)
+                stack.append(name)
+            if kind != START:
+                if not stack or stack[-1] != name:
+                    raise ValueError(f"Opening and ending tag mismatch: {stack[-1] if stack else None} and {name}")
+                target.end(name)
+                stack.pop()
+                self.root_closed = not stack
+
+
+class TEIStreamWriter:
+    """
+    Target of TEIBuilder which writes the TEI of a book while it is built. The elements of a zone are serialized as
+    soon as the zone is closed, so that only the zone being built is kept in memory. The output is the same as the
+    pretty printed tree of the whole book.
+
+    :param f: Text file to write to.
+    :param tei_header: Parsed TEI header.
+    """
+    # TEI > text > body > div > zones
+    zone_depth = 4
+
+    def __init__(self, f, tei_header):
+        self.f = f
+        # Open elements above the zones: name, attributes, whether the start tag was written
+        self.spine = [["TEI", {}, True]]
+        self.zone = None
+        self.zone_open = 0
+        # A zone is serialized inside empty elements so that lxml indents it as deep as in the whole book
+        self.wrapper = ET.Element("w")
+        self.slot = self.wrapper
+        for _ in range(self.zone_depth - 1):
+            self.slot = ET.SubElement(self.slot, "w")
+        self.prefix = sum(len("  " * i + "<w>\n") for i in range(self.zone_depth))
+        self.suffix = sum(len("  " * i + "</w>\n") for i in range(self.zone_depth))
+        f.write('<TEI xmlns="http://www.tei-c.org/ns/1.0">\n')
+        f.write("  " + ET.tostring(tei_header, encoding='unicode', pretty_print=True))
+
+    def start(self, tag, attrib):
+        if self.zone is not None:
+            self.zone.start(tag, attrib)
+            self.zone_open += 1
+            return
+        self._write_parent()
+        if len(self.spine) == self.zone_depth:
+            self.zone = ET.TreeBuilder()
+            self.zone.start(tag, attrib)
+            self.zone_open = 1
         else:
-            print('pas de matches')
-
-    elif cumul or is_list:
-        last_block = liste_block[-1]
-        last_tag = re.search('</[a-zA-Z]*>$', last_block)
-        tag_end = create_tag_end(tag)
-        if cumul:
-            last_tag_needed = tei_mapping[cumulative[zone_type]]
+            self.spine.append([tag, attrib, False])
+
+    def end(self, tag):
+        if self.zone is not None:
+            self.zone.end(tag)
+            self.zone_open -= 1
+            if not self.zone_open:
+                self.f.write(self._serialize(self.zone.close()))
+                self.zone = None
+            return
+        tag, attrib, written = self.spine.pop()
+        indent = "  " * len(self.spine)
+        if written:
+            self.f.write(f"{indent}</{tag}>\n")
         else:
-            last_tag_needed = create_tag_end(tag[0])
-        if last_tag and last_tag.group()==last_tag_needed:
-            if is_list:
-                tag_end = create_tag_end(tag[1])
-                tag = tag[1]
-            modified_block = last_block.replace(last_tag.group(), "") + tag + "".join(liste_line) + tag_end + last_tag.group()
-            liste_block[-1] = modified_block
+            self.f.write(indent + ET.tostring(ET.Element(tag, attrib), encoding='unicode') + "\n")
+
+    def data(self, data):
+        if self.zone is None:
+            raise ValueError("Text outside of a zone can not be streamed")
+        self.zone.data(data)
+
+    def close(self):
+        self.f.write("</TEI>\n")
+
+    def _write_parent(self):
+        parent = self.spine[-1]
+        if not parent[2]:
+            empty = ET.tostring(ET.Element(parent[0], parent[1]), encoding='unicode')
+            self.f.write("  " * (len(self.spine) - 1) + empty[:-2] + ">\n")
+            parent[2] = True
+
+    def _serialize(self, element):
+        self.slot.append(element)
+        try:
+            return ET.tostring(self.wrapper, encoding='unicode', pretty_print=True)[self.prefix:-self.suffix]
+        finally:
+            self.slot.remove(element)
+
+
+def write_file(path, content):
+    """
+    Writes [content] to [path] atomically, so that two workers never leave a half-written file behind.
+
+    :param path: Path of the file.
+    :param content: String to write.
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+def build_book(fulldir, xslt_file, builder, cache=None):
+    """
+    Adds the ALTO files of a book to [builder] and closes it.
+
+    :param fulldir: Directory containing the ALTO files of the book.
+    :param xslt_file: Path to the XSLT file, None to read the ALTO files directly.
+    :param builder: TEIBuilder of the book.
+    :param cache: PageCache of the book, if any.
+    :return: Result of the target of the builder.
+    """
+    n = 0
+    for xml_file in sorted(os.listdir(fulldir)):
+        if 'xml' in xml_file and 'METS' not in xml_file:
+            process_document(fulldir, xml_file, builder, xslt_file, n, cache)
+            n+=1
+    return builder.close()
+
+
+def stream_book(path, tei_header, fulldir, xslt_file, cache=None):
+    """
+    Writes the TEI of a book to [path] while it is built, memory is bound by the largest zone instead of the book.
+
+    :param path: Path of the TEI file.
+    :param tei_header: Parsed TEI header.
+    :param fulldir: Directory containing the ALTO files of the book.
+    :param xslt_file: Path to the XSLT file, None to read the ALTO files directly.
+    :param cache: PageCache of the book, if any.
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w") as f:
+            build_book(fulldir, xslt_file, TEIBuilder(TEIStreamWriter(f, tei_header), keep_raw=False), cache)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def book_to_tei(tei_header, fulldir, xslt_file, builder, cache=None):
+    """
+    Converts a book in memory.
+
+    :param tei_header: Parsed TEI header.
+    :param fulldir: Directory containing the ALTO files of the book.
+    :param xslt_file: Path to the XSLT file, None to read the ALTO files directly.
+    :param builder: TEIBuilder of the book.
+    :param cache: PageCache of the book, if any.
+    :return: The TEI document as a string.
+    """
+    root_xml = ET.Element("TEI", xmlns="http://www.tei-c.org/ns/1.0")
+    root_xml.append(tei_header)
+    root_xml.append(build_book(fulldir, xslt_file, builder, cache))
+    return ET.tostring(root_xml, encoding='unicode', pretty_print=True)
+
+
+def check_parity(row, fulldir, xslt_file, pattern_header):
+    """
+    Converts a book with the XSLT and with read_alto_zones(), without writing anything, and compares the TEI (or the
+    raw blocks of TEI/error/) byte for byte.
+
+    :param row: Metadata of the book.
+    :param fulldir: Directory containing the ALTO files of the book.
+    :param xslt_file: Path to the XSLT file.
+    :param pattern_header: Path to the header template, or None for the default one.
+    :return: True if both conversions are identical.
+    """
+    outputs = []
+    for reader in (xslt_file, None):
+        builder = TEIBuilder()
+        try:
+            tei_header = ET.fromstring(fill_header(pattern_header or "resources/basic_header.txt", row))
+            outputs.append(book_to_tei(tei_header, fulldir, reader, builder))
+        except Exception as e:
+            outputs.append(f"{type(e).__name__}\n{builder.raw_string()}")
+    identical = outputs[0] == outputs[1]
+    print(f'Parity {"OK" if identical else "FAILED"}: {row["file_name"]}')
+    return identical
+
+
+def convert_book(row, fulldir, xslt_file, pattern_header, stream=False, cache_dir=None):
+    """
+    Converts the ALTO files of one book to TEI/[file_name].xml, or writes the raw blocks to TEI/error/[file_name].xml
+    when the conversion fails.
+
+    :param row: Metadata of the book.
+    :param fulldir: Directory containing the ALTO files of the book.
+    :param xslt_file: Path to the XSLT file, None to read the ALTO files directly.
+    :param pattern_header: Path to the header template, or None for the default one.
+    :param stream: Writes the TEI file while it is built.
+    :param cache_dir: Directory of the page caches, one subdirectory per book.
+    :return: True if the TEI file was written.
+    """
+    print(f'Parsing {row["file_name"]}')
+    output = os.path.basename(row["file_name"])
+    builder = TEIBuilder()
+    streamed = False
+    cache = None
+    try:
+        if cache_dir:
+            cache = PageCache(os.path.join(cache_dir, output), xslt_file)
+        tei_header = ET.fromstring(fill_header(pattern_header or "resources/basic_header.txt", row))
+        if stream:
+            streamed = True
+            stream_book(f'TEI/{output}.xml', tei_header, fulldir, xslt_file, cache)
         else:
-            liste_block.append("".join(tag) + "".join(liste_line) + tag_end)
-    elif (zone_type=="MainZone-Head" and any("<head>" in el for el in liste_block)): 
-        tag_end = create_tag_end(tag)
-        liste_block.append("</div><div>"+tag + "".join(liste_line)+tag_end)
-    else:
-        tag_end = create_tag_end(tag)
-        liste_block.append(tag + "".join(liste_line) + tag_end)
-    
-    return liste_block
+            write_file(f'TEI/{output}.xml', book_to_tei(tei_header, fulldir, xslt_file, builder, cache))
+        return True
+    except Exception as e:
+        print(f"Error: {e}")
+        print(f"Writing block to file TEI/error/{output}.xml")
+        if streamed:
+            # Streamed blocks are not kept: the book is assembled again, in memory, for the error file
+            try:
+                build_book(fulldir, xslt_file, builder, cache)
+            except Exception:
+                pass
+        os.makedirs('TEI/error/', exist_ok=True)
+        write_file(f'TEI/error/{output}.xml', builder.raw_string())
+        return False
 
 
+def _convert_book_job(job):
+    return convert_book(*job)
+
+
+def _check_parity_job(job):
+    return check_parity(*job[:4])
+
 
-    
 @click.command()
 @click.argument('directory', type=str)
 @click.argument('csv_metadata', type=str)
 @click.argument('pattern_header', type=str, required=False)
-def main(directory, csv_metadata, pattern_header):
+@click.option('--workers', type=int, default=1, show_default=True,
+              help="Number of processes converting books in parallel")
+@click.option('--stream', is_flag=True, default=False,
+              help="Writes each TEI file while it is built, memory is bound by the largest zone instead of the book")
+@click.option('--cache', 'cache_dir', type=str, default=None,
+              help="Directory keeping the zones of each page between runs, only changed pages are read again")
+@click.option('--direct', is_flag=True, default=False,
+              help="Reads the ALTO files in a single pass instead of applying resources/alto2XMLsimple.xsl")
+@click.option('--parity', is_flag=True, default=False,
+              help="Only checks that --direct gives the same TEI as the XSLT, byte for byte, for each book")
+def main(directory, csv_metadata, pattern_header, workers, stream, cache_dir, direct, parity):
     if not os.path.exists('TEI'):
         os.makedirs('TEI')
-    xslt_file = "resources/alto2XMLsimple.xsl"
+    xslt_file = "resources/alto2XMLsimple.xsl" if parity or not direct else None
+    subdirs = index_directories(directory)
+    jobs = []
     with open(csv_metadata, newline='', encoding="utf-8") as csv_file:
         reader=csv.DictReader(csv_file, delimiter="\t")
-
         for row in reader:
-            print(f'Parsing {row["file_name"]}')
-            root_xml = ET.Element("TEI", xmlns="http://www.tei-c.org/ns/1.0")
-            if pattern_header:
-                tei_header = fill_header(pattern_header, row)
-            else:
-                tei_header_path = "resources/basic_header.txt"
-                tei_header = fill_header(tei_header_path, row)
-            root_xml.append(ET.fromstring(tei_header))
-            liste_block = ["<text><body><div>"]
-            n = 0
-
-            subdirs = glob(os.path.join(directory, "**/"), recursive = True)
-            subdirs = {os.path.basename(os.path.normpath(d)): d for d in subdirs}
-
-            try:
-                fulldir = subdirs[row["file_name"]]
-                for xml_file in sorted(os.listdir(fulldir)):
-                    if 'xml' in xml_file and 'METS' not in xml_file:
-                        liste_block = process_document(fulldir, xml_file, liste_block, xslt_file, n)
-                        n+=1
-                liste_block.append("</div></body></text>")
-                block_str = "".join(liste_block)
-                output=os.path.basename(row["file_name"])
-                try:
-                    block_tei = ET.fromstring(block_str)
-                    root_xml.append(block_tei)
-                    with open(f'TEI/{output}.xml', "w") as f:
-                        f.write(ET.tostring(root_xml, encoding='unicode', pretty_print=True))
-                except Exception as e:
-                    print(f"Error: {e}")
-                    print(f"Writing block to file TEI/error/{output}.xml")
-                    if not os.path.exists('TEI/error/'):
-                        os.makedirs('TEI/error/')
-                    with open(f'TEI/error/{output}.xml', "w") as f:
-                        f.write(block_str)
-            except KeyError:
+            if row["file_name"] not in subdirs:
                 print(f"Error: {row['file_name']} not found in subdirs.")
+                continue
+            jobs.append((row, subdirs[row["file_name"]], xslt_file, pattern_header, stream, cache_dir))
+
+    job_function = _check_parity_job if parity else _convert_book_job
+    if workers > 1:
+        # Each book is written by its own worker, results are only collected to keep the failures count
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(job_function, jobs))
+    else:
+        results = [job_function(job) for job in jobs]
+    if parity:
+        print(f"{sum(results)}/{len(jobs)} books identical with --direct")
+        if not all(results):
+            raise SystemExit(1)
+    else:
+        print(f"{sum(results)}/{len(jobs)} books converted, {len(jobs)-sum(results)} written to TEI/error/")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
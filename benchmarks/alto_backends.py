@@ -0,0 +1,86 @@
+""" Scaling of the thread and process backends for lxml-heavy tasks
+
+Generates synthetic Kraken-like ALTO files and times `CleanUpAltoGlyphs`, `ExtractZoneAltoCommand` and
+`KrakenAltoCleanUpCommand` with both backends, for several numbers of workers. Run it from the repository root:
+
+    uv run python -m benchmarks.alto_backends --pages 400 --workers 1 2 4 8
+"""
+import os
+import time
+import random
+import argparse
+import tempfile
+from typing import List, Callable, Dict
+# Local
+from rtk.task import CleanUpAltoGlyphs, ExtractZoneAltoCommand, KrakenAltoCleanUpCommand, Task
+
+
+def synthetic_alto(blocks: int = 20, lines: int = 15, words: int = 8) -> str:
+    """ Generates an ALTO looking like a Kraken output, floats and glyphs included """
+    rand = random.Random(0)
+    out = []
+    for block in range(blocks):
+        out.append(f'<TextBlock ID="b{block}" TAGREFS="TYPE_1">')
+        for line in range(lines):
+            out.append(f'<TextLine ID="b{block}l{line}" BASELINE="10.5 20.25 30.75 40.5" HPOS="1.5" VPOS="2.5" '
+                       f'WIDTH="300.25" HEIGHT="20.75">')
+            for word in range(words):
+                glyphs = "".join(
+                    f'<Glyph ID="g{block}-{line}-{word}-{g}" CONTENT="a" HPOS="{rand.random():.4f}" VPOS="1.5" '
+                    f'WIDTH="2.5" HEIGHT="3.5" GC="0.99"/>'
+                    for g in range(5)
+                )
+                out.append(f'<String CONTENT="mot{word}" HPOS="{rand.random() * 100:.4f}" VPOS="2.5" WIDTH="20.5" '
+                           f'HEIGHT="10.5">{glyphs}</String><SP/>')
+            out.append('</TextLine>')
+        out.append('</TextBlock>')
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<alto xmlns="http://www.loc.gov/standards/alto/ns-v4#">
+<Description><sourceImageInformation><fileName>../some/folder/page.jpg</fileName></sourceImageInformation></Description>
+<Tags><OtherTag ID="TYPE_1" LABEL="MainZone"/></Tags>
+<Layout><Page><PrintSpace>{"".join(out)}</PrintSpace></Page></Layout>
+</alto>"""
+
+
+def write_pages(directory: str, pages: int, content: str) -> List[str]:
+    files = []
+    for page in range(pages):
+        files.append(os.path.join(directory, f"page-f{page}.xml"))
+        with open(files[-1], "w") as f:
+            f.write(content)
+    return files
+
+
+TASKS: Dict[str, Callable[..., Task]] = {
+    "CleanUpAltoGlyphs": lambda files, **kwargs: CleanUpAltoGlyphs(files, **kwargs),
+    "ExtractZoneAltoCommand": lambda files, **kwargs: ExtractZoneAltoCommand(files, zones=["MainZone"], **kwargs),
+    "KrakenAltoCleanUpCommand": lambda files, **kwargs: KrakenAltoCleanUpCommand(files, **kwargs),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the thread and process backends of lxml-heavy tasks')
+    parser.add_argument('--pages', type=int, default=200, help='number of ALTO files')
+    parser.add_argument('--workers', type=int, nargs="+", default=[1, 2, 4, 8], help='numbers of workers to test')
+    parser.add_argument('--tasks', nargs="+", default=list(TASKS), choices=list(TASKS), help='tasks to benchmark')
+    args = parser.parse_args()
+
+    content = synthetic_alto()
+    print(f"{'task':<26}{'backend':<9}{'workers':>8}{'seconds':>10}{'pages/s':>10}{'speed-up':>10}")
+    with tempfile.TemporaryDirectory() as directory:
+        for name in args.tasks:
+            for backend in ("thread", "process"):
+                reference = None
+                for workers in args.workers:
+                    files = write_pages(directory, args.pages, content)
+                    task = TASKS[name](files, multiprocess=workers, backend=backend)
+                    start = time.perf_counter()
+                    task._process(files)
+                    elapsed = time.perf_counter() - start
+                    reference = reference or elapsed
+                    print(f"{name:<26}{backend:<9}{workers:>8}{elapsed:>10.2f}{args.pages / elapsed:>10.1f}"
+                          f"{reference / elapsed:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
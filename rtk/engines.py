@@ -0,0 +1,200 @@
+# Std lib
+import os
+import signal
+import pathlib
+import dataclasses
+from contextlib import contextmanager
+from typing import List, Optional, Tuple, Union, Callable
+# Non std lib are imported lazily: torch, kraken and yaltai are only required when an engine is loaded
+
+
+EngineFactory = Callable[[], "Engine"]
+
+# One engine per worker process, loaded by `init_worker` and reused for every batch sent to this process
+_ENGINE: Optional["Engine"] = None
+
+
+class Engine:
+    """ In-process replacement for a kraken-like CLI call: models are loaded once, then pages are processed
+    through the Python API of kraken/yaltai.
+
+    :param device: Device to run inference on
+    :param raise_on_error: Raise the original exception instead of skipping the page
+    """
+    def __init__(self, device: str = "cpu", raise_on_error: bool = False):
+        self.device: str = device
+        self.raise_on_error: bool = raise_on_error
+        self._loaded: bool = False
+
+    def load(self) -> None:
+        """ Load the models, called once per worker """
+        raise NotImplementedError
+
+    def process_page(self, inp: str, out: str) -> None:
+        """ Process [INP] and writes its ALTO serialization to [OUT] """
+        raise NotImplementedError
+
+    def process(self, inputs: List[Tuple[str, str]], max_time_per_op: Optional[int] = None) -> List[str]:
+        """ Process a list of (input, output) couples and returns the outputs that were written
+
+        :param inputs: List of (input file, output file)
+        :param max_time_per_op: Maximum time in seconds for a single page, the page is skipped when it runs out
+        :return: List of output files that were produced
+        """
+        if not self._loaded:
+            self.load()
+            self._loaded = True
+        out = []
+        for inp, target in inputs:
+            try:
+                with _page_timeout(max_time_per_op):
+                    self.process_page(inp, target)
+                out.append(target)
+            except Exception as E:
+                if self.raise_on_error:
+                    raise E
+                print(f"Error while processing {inp}: {E}")
+        return out
+
+    @staticmethod
+    def _serialize(results, image_size: Tuple[int, int], target: str) -> None:
+        from kraken import serialization
+        with open(target, "w", encoding="utf-8") as f:
+            f.write(serialization.serialize(results, image_size=image_size, template="alto"))
+
+
+@contextmanager
+def _page_timeout(seconds: Optional[int]):
+    """ Raises a TimeoutError if the block runs for more than [SECONDS]. Only works in the main thread of a process,
+    which is the case of the worker processes. """
+    if not seconds:
+        yield
+        return
+
+    def handler(signum, frame):
+        raise TimeoutError(f"Page took more than {seconds}s")
+
+    previous = signal.signal(signal.SIGALRM, handler)
+    signal.alarm(seconds)
+    try:
+        yield
+    finally:
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def _load_segmentation_model(model: Optional[Union[str, pathlib.Path]]):
+    """ Loads a custom segmentation model. Without one, None is returned: `blla.segment` (and yaltai) then load the
+    default model bundled with kraken, as the `segment` CLI does. """
+    if not model:
+        return None
+    from kraken.lib import vgsl
+    return vgsl.TorchVGSLModel.load_model(str(model))
+
+
+class YALTAiEngine(Engine):
+    """ YOLO zone detection + kraken line segmentation, equivalent to `yaltai kraken --alto R segment -y`
+
+    :param yolo_model: Path to a YOLOv8 model
+    :param line_model: [Optional] Path to a custom kraken line segmentation model
+    """
+    def __init__(
+            self,
+            yolo_model: Union[str, pathlib.Path],
+            line_model: Optional[Union[str, pathlib.Path]] = None,
+            **kwargs):
+        super(YALTAiEngine, self).__init__(**kwargs)
+        self.yolo_model_path: str = str(yolo_model)
+        self.line_model_path: Optional[str] = str(line_model) if line_model else None
+        self._yolo = None
+        self._line = None
+
+    def load(self) -> None:
+        from ultralytics import YOLO
+        self._yolo = YOLO(self.yolo_model_path)
+        self._line = _load_segmentation_model(self.line_model_path)
+
+    def process_page(self, inp: str, out: str) -> None:
+        from PIL import Image
+        from yaltai.models.krakn import segment
+        im = Image.open(inp)
+        res = segment(
+            im,
+            model=self._line,
+            device=self.device,
+            yolo_model=self._yolo,
+            raise_on_error=self.raise_on_error
+        )
+        # Like the CLI, the image path is written as given, `KrakenAltoCleanUpCommand` still applies
+        self._serialize(dataclasses.replace(res, imagename=inp), image_size=im.size, target=out)
+
+
+class KrakenRecognizerEngine(Engine):
+    """ Kraken recognition of an existing ALTO segmentation, equivalent to `kraken -f xml --alto R ocr -m`
+
+    :param model: Path to the recognition model
+    """
+    def __init__(self, model: Union[str, pathlib.Path], **kwargs):
+        super(KrakenRecognizerEngine, self).__init__(**kwargs)
+        self.model_path: str = str(model)
+        self._model = None
+
+    def load(self) -> None:
+        from kraken.lib import models
+        self._model = models.load_any(self.model_path, device=self.device)
+
+    def _recognize(self, im, bounds, imagename: str, target: str) -> None:
+        from kraken import rpred
+        it = rpred.rpred(self._model, im, bounds)
+        preds = list(it)
+        results = dataclasses.replace(it.bounds, lines=preds, imagename=imagename)
+        self._serialize(results, image_size=im.size, target=target)
+
+    def process_page(self, inp: str, out: str) -> None:
+        from PIL import Image
+        from kraken.lib.xml import XMLPage
+        page = XMLPage(inp)
+        bounds = page.to_container()
+        im = Image.open(page.imagename)
+        self._recognize(im, bounds, imagename=str(page.imagename), target=out)
+
+
+class KrakenSegAndRecEngine(KrakenRecognizerEngine):
+    """ Kraken segmentation followed by recognition, equivalent to `kraken -f image --alto R segment ocr -m`
+
+    :param model: Path to the recognition model
+    :param seg_model: [Optional] Path to the segmentation model, default kraken model otherwise
+    """
+    def __init__(self, model: Union[str, pathlib.Path], seg_model: Optional[Union[str, pathlib.Path]] = None, **kwargs):
+        super(KrakenSegAndRecEngine, self).__init__(model=model, **kwargs)
+        self.seg_model_path: Optional[str] = str(seg_model) if seg_model else None
+        self._seg = None
+
+    def load(self) -> None:
+        super(KrakenSegAndRecEngine, self).load()
+        self._seg = _load_segmentation_model(self.seg_model_path)
+
+    def process_page(self, inp: str, out: str) -> None:
+        from PIL import Image
+        from kraken import blla
+        im = Image.open(inp)
+        bounds = blla.segment(im, model=self._seg, device=self.device, raise_on_error=self.raise_on_error)
+        self._recognize(im, bounds, imagename=inp, target=out)
+
+
+def init_worker(factory: EngineFactory) -> None:
+    """ Initializer of a worker process: limits torch to one thread and loads the engine models once """
+    global _ENGINE
+    os.environ["OMP_NUM_THREADS"] = "1"
+    import torch
+    torch.set_num_threads(1)
+    _ENGINE = factory()
+    _ENGINE.load()
+    _ENGINE._loaded = True
+
+
+def run_worker(inputs: List[Tuple[str, str]], max_time_per_op: Optional[int] = None) -> List[str]:
+    """ Process a batch of (input, output) with the engine of the current worker process """
+    if _ENGINE is None:
+        raise RuntimeError("The worker was not initialized with `init_worker`")
+    return _ENGINE.process(inputs, max_time_per_op=max_time_per_op)
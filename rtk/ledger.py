@@ -0,0 +1,146 @@
+# Std lib
+import os
+import json
+import sqlite3
+import threading
+from typing import Dict, Iterable, NamedTuple, Optional, Any, Tuple
+
+
+class LedgerEntry(NamedTuple):
+    page: str
+    stage: str
+    status: str
+    output: Optional[str]
+    mtime: Optional[float]
+    size: Optional[int]
+    lines: Optional[int]
+    text_lines: Optional[int]
+    meta: Optional[Dict[str, Any]]
+
+
+class Ledger:
+    """ Persistent record of the state of each page for each stage (page -> stage -> status, output mtime, size and
+    content stats), so that `Task.check()` does not need to stat and parse every output on resume.
+
+    The ledger is a SQLite database: keep it on a local disk or use one ledger per job, SQLite locking is not
+    reliable on network file systems.
+
+    By default, an entry is done only if its output still has the recorded mtime and size (one stat, no parsing): a
+    deleted or overwritten output is processed again.
+
+    >>> ledger = Ledger(":memory:", verify=False)
+    >>> ledger.record("ocr", "page.jpg", output="page.xml", lines=10, text_lines=9, stat=False)
+    >>> ledger.entries("ocr")["page.jpg"].text_lines
+    9
+    >>> ledger.is_done(ledger.entries("ocr")["page.jpg"])
+    True
+    >>> ledger.source_of("ocr", "page.xml")
+    'page.jpg'
+
+    :param path: Path to the SQLite database
+    :param verify: Compares the recorded mtime and size of outputs with the file system. Without it, the ledger is
+        trusted as is.
+    """
+    DONE = "done"
+
+    def __init__(self, path: str, verify: bool = True):
+        self.path: str = path
+        self.verify: bool = verify
+        self._lock = threading.Lock()
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            " page TEXT NOT NULL, stage TEXT NOT NULL, status TEXT NOT NULL, output TEXT,"
+            " mtime REAL, size INTEGER, lines INTEGER, text_lines INTEGER, meta TEXT,"
+            " PRIMARY KEY (page, stage))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS pages_output ON pages (output, stage)")
+        self._db.commit()
+
+    @staticmethod
+    def _entry(row: Tuple) -> LedgerEntry:
+        return LedgerEntry(*row[:-1], meta=json.loads(row[-1]) if row[-1] else None)
+
+    def entries(self, stage: str) -> Dict[str, LedgerEntry]:
+        """ Retrieves all the entries of a stage in a single query, indexed by page """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT page, stage, status, output, mtime, size, lines, text_lines, meta FROM pages WHERE stage = ?",
+                (stage, )
+            ).fetchall()
+        return {row[0]: self._entry(row) for row in rows}
+
+    def source_of(self, stage: str, output: str) -> Optional[str]:
+        """ Retrieves the page which produced [OUTPUT] at [STAGE] """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT page FROM pages WHERE output = ? AND stage = ?", (output, stage)
+            ).fetchone()
+        return row[0] if row else None
+
+    def is_done(self, entry: Optional[LedgerEntry]) -> bool:
+        """ Checks that an entry is done and, if the ledger verifies entries, that its output was not changed since """
+        if entry is None or entry.status != self.DONE:
+            return False
+        if self.verify and entry.output:
+            try:
+                stat = os.stat(entry.output)
+            except OSError:
+                return False
+            return stat.st_mtime == entry.mtime and stat.st_size == entry.size
+        return True
+
+    def record_many(self, stage: str, records: Iterable[Dict[str, Any]]) -> None:
+        """ Records several pages at once, see `record` for the keys of each record """
+        rows = []
+        for record in records:
+            output = record.get("output")
+            mtime, size = None, None
+            if output and record.get("stat", True):
+                try:
+                    stat = os.stat(output)
+                    mtime, size = stat.st_mtime, stat.st_size
+                except OSError:
+                    continue
+            rows.append((
+                record["page"], stage, record.get("status", self.DONE), output, mtime, size,
+                record.get("lines"), record.get("text_lines"),
+                json.dumps(record["meta"]) if record.get("meta") is not None else None
+            ))
+        if not rows:
+            return
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._db.commit()
+
+    def record(
+            self,
+            stage: str,
+            page: str,
+            output: Optional[str] = None,
+            status: str = DONE,
+            lines: Optional[int] = None,
+            text_lines: Optional[int] = None,
+            meta: Optional[Dict[str, Any]] = None,
+            stat: bool = True
+    ) -> None:
+        """ Records the state of [PAGE] for [STAGE]
+
+        :param stage: Name of the stage (By default, tasks use their class name)
+        :param page: Input of the stage
+        :param output: Output file of the stage, its mtime and size are recorded when [STAT] is True
+        :param status: Status of the page
+        :param lines: Number of lines (ALTO String) of the output
+        :param text_lines: Number of lines (ALTO String) with text in the output
+        :param meta: Any additional JSON serializable information
+        :param stat: Reads the mtime and size of the output
+        """
+        self.record_many(stage, [dict(
+            page=page, output=output, status=status, lines=lines, text_lines=text_lines, meta=meta, stat=stat
+        )])
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
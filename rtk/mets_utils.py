@@ -2,18 +2,61 @@
 import os
 import re
 import glob
+import time
 import zipfile
 # Std Lib partial
-from typing import Optional
+from typing import Optional, Dict, List, Tuple, NamedTuple
 from pathlib import Path
 # Requirements
 import lxml.etree as ET
 
 
-def produce_mets(directory: str, exclude: Optional[str] = None) -> None:
+# Already compressed formats: DEFLATE costs CPU for no gain
+STORED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".jp2", ".gif", ".webp"}
+
+
+class PackageReport(NamedTuple):
+    archive: str
+    status: str
+    bytes_in: int
+    bytes_out: int
+    seconds: float
+
+
+def compression_for(file: str) -> int:
+    """ Compression of a member of the archive, depending on its extension """
+    if os.path.splitext(file)[1].lower() in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def alto_image_name(path: str) -> str:
+    """ Reads the first fileName of an ALTO file, which is in its header (sourceImageInformation): parsing stops
+    there instead of building the whole document
+    """
+    for _, element in ET.iterparse(path, events=("end", ), tag="{*}fileName"):
+        return element.text
+    raise ValueError(f"No fileName in {path}")
+
+
+def page_sort_key(path: str) -> Tuple[int, int, str]:
+    """ Natural order of the pages of a book, files without a page number come last
+
+    >>> sorted(["b-f10.xml", "b-f2.xml", "b.xml", "b-f1.xml"], key=page_sort_key)
+    ['b-f1.xml', 'b-f2.xml', 'b-f10.xml', 'b.xml']
+    """
+    number = re.findall(r"-f(\d+)\.xml$", path)
+    if number:
+        return 0, int(number[0]), path
+    return 1, 0, path
+
+
+def produce_mets(directory: str, exclude: Optional[str] = None, image_names: Optional[Dict[str, str]] = None) -> None:
     """ Generate a METS.xml file based on a directory of XML files and JPGs
+
+    :param image_names: Image of each XML file (e.g. from the ledger), keyed by normalized path. The image of other
+        XML files is read from their header.
     """
-    mets_found = 0
     images = []
     transc = []
 
@@ -25,26 +68,14 @@ def produce_mets(directory: str, exclude: Optional[str] = None) -> None:
         """ Generate the xml line """
         return f'        <file ID="export{num}">\n          <FLocat xlink:href="{Path(path).name}"/>\n        </file>'
 
-    def sorting_value(key):
-        if "METS" in key:
-            return -1
-        number = re.findall(r"-f(\d+)\.xml", key)
-        if number:
-            return int(number[0])
-        else:
-            return key
-
-    for idx, fp_t in enumerate(sorted(glob.glob(f"{directory}/*.xml"))):
-        if "METS.xml" in fp_t:
-            mets_found -= 1
-            continue
-        if exclude and exclude in fp_t:
-            mets_found -= 1
-            continue
-        xml = ET.parse(fp_t)
-        fp_i = xml.findall("//{*}fileName")[0].text
-        images.append(produce_image(fp_i, idx + mets_found))
-        transc.append(produce_xml(fp_t, idx + mets_found))
+    files = [
+        fp_t for fp_t in glob.glob(f"{directory}/*.xml")
+        if "METS.xml" not in fp_t and not (exclude and exclude in fp_t)
+    ]
+    for idx, fp_t in enumerate(sorted(files, key=page_sort_key)):
+        fp_i = (image_names or {}).get(os.path.normpath(fp_t)) or alto_image_name(fp_t)
+        images.append(produce_image(fp_i, idx))
+        transc.append(produce_xml(fp_t, idx))
 
     groups = [
         f'      <div TYPE="page">\n        <fptr FILEID="image{idx}"/><fptr FILEID="export{idx}"/>\n      </div>'
@@ -67,23 +98,125 @@ def produce_mets(directory: str, exclude: Optional[str] = None) -> None:
   </structMap>
 </mets>"""
 
+    # Rewriting an unchanged METS.xml would change its mtime, and the archive would look outdated
+    if os.path.exists(f"{directory}/METS.xml"):
+        with open(f"{directory}/METS.xml") as f:
+            if f.read() == METS:
+                return
     with open(f"{directory}/METS.xml", "w") as f:
         f.write(METS)
 
 
-def zip_folder(folder_path, output_path, exclude: Optional[str] = None):
+def _zip_files(folder_path: str, exclude: Optional[str] = None) -> List[str]:
     # Get the list of files in the folder
     files = os.listdir(folder_path)
     # Sort files to add image files first and then XML files
     files.sort(key=lambda x: (x.endswith('.xml'), x.endswith('.jpg')))
+    return [file for file in files if not (exclude and exclude in file)]
+
+
+def _zip_time(date_time: Tuple[int, ...]) -> Tuple[int, ...]:
+    """ Zip archives store modification times with a two seconds precision """
+    return tuple(date_time[:5]) + (date_time[5] // 2 * 2, )
+
+
+def zip_changes(
+        folder_path: str,
+        output_path: str,
+        exclude: Optional[str] = None
+) -> Optional[Tuple[List[str], List[str], List[str]]]:
+    """ Compares the files `zip_folder` would archive with the members of an existing archive, using only the size
+    and modification time of each file and the central directory of the archive (nothing is read or decompressed)
+
+    :return: Names of the (added, changed, removed) members, None if the archive does not exist or is unreadable
+    """
+    try:
+        with zipfile.ZipFile(output_path) as zipf:
+            archived: Dict[str, zipfile.ZipInfo] = {info.filename: info for info in zipf.infolist()}
+    except (OSError, zipfile.BadZipFile):
+        return None
+    added, changed = [], []
+    current = set()
+    for file in _zip_files(folder_path, exclude):
+        info = zipfile.ZipInfo.from_file(os.path.join(folder_path, file), arcname=file)
+        current.add(info.filename)
+        if info.filename not in archived:
+            added.append(info.filename)
+        elif (archived[info.filename].file_size != info.file_size
+              or _zip_time(archived[info.filename].date_time) != _zip_time(info.date_time)):
+            changed.append(info.filename)
+    removed = [name for name in archived if name not in current]
+    return added, changed, removed
+
+
+def update_zip_folder(
+        folder_path: str,
+        output_path: str,
+        exclude: Optional[str] = None,
+        deflate_level: int = 6
+) -> str:
+    """ Brings the archive of a folder up to date: nothing is done if no file changed, new files are appended, and
+    the archive is rebuilt if a file was changed or removed (zip members can not be replaced in place).
+
+    :param deflate_level: Compression level of the DEFLATEd members (0-9), see `zip_folder`
+    :return: "unchanged", "appended", "rebuilt" or "created"
+    """
+    changes = zip_changes(folder_path, output_path, exclude=exclude)
+    if changes is not None:
+        added, changed, removed = changes
+        if not added and not changed and not removed:
+            return "unchanged"
+        if not changed and not removed:
+            with zipfile.ZipFile(output_path, 'a', zipfile.ZIP_DEFLATED) as zipf:
+                for name in added:
+                    zipf.write(
+                        os.path.join(folder_path, name), arcname=name,
+                        compress_type=compression_for(name), compresslevel=deflate_level
+                    )
+            return "appended"
+    status = "rebuilt" if os.path.exists(output_path) else "created"
+    tmp = f"{output_path}.tmp"
+    zip_folder(folder_path, tmp, exclude=exclude, deflate_level=deflate_level)
+    os.replace(tmp, output_path)
+    return status
+
+
+def zip_folder(folder_path, output_path, exclude: Optional[str] = None, deflate_level: int = 6):
+    """ Zips the files of a folder, images first. Already compressed images (JPEG, PNG...) are STORED, other files
+    are DEFLATEd with [DEFLATE_LEVEL] (1 is the fastest, 9 the smallest)
+    """
+    files = _zip_files(folder_path, exclude)
 
     # Create a ZipFile object
     with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
         # Add each file to the zip file
         for file in files:
-            if exclude and exclude in file:
-                continue
             file_path = os.path.join(folder_path, file)
-            zipf.write(file_path, arcname=file)
+            zipf.write(file_path, arcname=file, compress_type=compression_for(file), compresslevel=deflate_level)
     return output_path
 
+
+def package_folder(
+        folder_path: str,
+        output_path: str,
+        deflate_level: int = 6,
+        image_names: Optional[Dict[str, str]] = None
+) -> PackageReport:
+    """ Produces the METS.xml of a folder and brings its archive up to date
+
+    :param image_names: See `produce_mets`
+    :return: Status of the archive, sizes of the archived files and of the archive, and time spent
+    """
+    start = time.perf_counter()
+    produce_mets(folder_path, exclude="METS.xml", image_names=image_names)
+    status = update_zip_folder(folder_path, output_path, deflate_level=deflate_level)
+    with zipfile.ZipFile(output_path) as zipf:
+        bytes_in = sum(info.file_size for info in zipf.infolist())
+    return PackageReport(
+        archive=output_path,
+        status=status,
+        bytes_in=bytes_in,
+        bytes_out=os.path.getsize(output_path),
+        seconds=time.perf_counter() - start
+    )
+
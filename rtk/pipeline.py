@@ -0,0 +1,66 @@
+# Std lib
+import queue
+import threading
+from typing import List, Optional
+# Local
+from rtk.task import Task, STREAM_END
+
+
+class StreamingPipeline:
+    """ Chains tasks so that each page moves to the next task as soon as it is done, instead of waiting for the
+    whole previous task to finish. Tasks are connected with bounded queues, so that a fast task does not run ahead
+    of a slow one.
+
+    The first task is fed with its input files, the input files of the following tasks must cover the outputs of
+    the previous task (they are used for `check()` and progress only).
+
+    >>> StreamingPipeline([])
+    Traceback (most recent call last):
+     ...
+    ValueError: A pipeline requires at least one task
+
+    :param tasks: Tasks to chain, in order
+    :param queue_size: Maximum number of pages waiting between two tasks
+    """
+    def __init__(self, tasks: List[Task], queue_size: int = 20):
+        if not tasks:
+            raise ValueError("A pipeline requires at least one task")
+        self.tasks: List[Task] = tasks
+        self.queue_size: int = queue_size
+        self._errors: List[BaseException] = []
+
+    def _run_task(self, task: Task, source: queue.Queue, sink: Optional[queue.Queue]) -> None:
+        try:
+            task.stream(source, sink)
+        except BaseException as E:
+            self._errors.append(E)
+            # Drain what is left so that the previous task is never blocked on a full queue
+            while source.get() is not STREAM_END:
+                continue
+        finally:
+            if sink is not None:
+                sink.put(STREAM_END)
+
+    def run(self) -> bool:
+        for task in self.tasks:
+            task.check()
+
+        first: queue.Queue = queue.Queue()
+        for inp in self.tasks[0].input_files:
+            first.put(inp)
+        first.put(STREAM_END)
+
+        sources = [first] + [queue.Queue(maxsize=self.queue_size) for _ in self.tasks[1:]]
+        sinks = sources[1:] + [None]
+        threads = [
+            threading.Thread(target=self._run_task, args=(task, source, sink))
+            for task, source, sink in zip(self.tasks, sources, sinks)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self._errors:
+            raise self._errors[0]
+        return True
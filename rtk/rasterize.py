@@ -0,0 +1,141 @@
+# Std lib
+import os
+import math
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Literal, Tuple
+# Non std lib
+import fitz  # PyMuPDF
+
+
+COLORSPACES: Dict[str, "fitz.Colorspace"] = {"rgb": fitz.csRGB, "gray": fitz.csGRAY}
+
+
+def page_ranges(start_on: int, n_pages: int, splits: int) -> List[range]:
+    """ Splits the pages of a PDF in contiguous ranges, one job each
+
+    >>> page_ranges(0, 10, 3)
+    [range(0, 4), range(4, 8), range(8, 10)]
+    >>> page_ranges(2, 3, 4)
+    [range(2, 3)]
+    """
+    size = max(1, math.ceil((n_pages - start_on) / splits))
+    return [range(first, min(first + size, n_pages)) for first in range(start_on, n_pages, size)]
+
+
+def render_pages(
+        pdf_path: str,
+        pages: range,
+        scheme_string: str,
+        dpi: int = 300,
+        colorspace: str = "rgb",
+        fmt: str = "jpg",
+        quality: int = 95,
+        numbering_start: int = 0
+) -> List[str]:
+    """ Renders [PAGES] of a PDF, each page being written (then freed) as soon as it is rendered. Files are written
+    under a temporary name first, so that an existing page image is always complete.
+
+    :return: Paths of the page images
+    """
+    out = []
+    doc = fitz.open(pdf_path)
+    try:
+        for i in pages:
+            pix = doc.load_page(i).get_pixmap(dpi=dpi, colorspace=COLORSPACES[colorspace], alpha=False)
+            target = scheme_string.format(i + numbering_start)
+            pix.save(f"{target}.part", output=fmt, jpg_quality=quality)
+            os.replace(f"{target}.part", target)
+            out.append(target)
+    finally:
+        doc.close()
+    return out
+
+
+def _render_job(job: Tuple[str, range, str, Dict]) -> List[str]:
+    pdf_path, pages, scheme_string, options = job
+    return render_pages(pdf_path, pages, scheme_string, **options)
+
+
+class PDFRasterizer:
+    """ Renders the pages of PDFs as images with PyMuPDF.
+
+    The pages of a PDF are split in ranges rendered by a pool of [WORKERS] processes, so that a single big PDF uses
+    every core. Pages are written one by one, memory does not depend on the number of pages.
+
+    :param dpi: Resolution of the images
+    :param colorspace: Colour space of the images (rgb, gray)
+    :param fmt: Format of the images (Any output of `fitz.Pixmap.save`: jpg, png, pnm...)
+    :param quality: JPG quality
+    :param workers: Number of processes, pages are rendered in the current process with 1
+    :param jobs_per_worker: Number of page ranges a PDF is split in, per worker
+    """
+    def __init__(
+            self,
+            dpi: int = 300,
+            colorspace: Literal["rgb", "gray"] = "rgb",
+            fmt: str = "jpg",
+            quality: int = 95,
+            workers: int = 1,
+            jobs_per_worker: int = 2
+    ):
+        if colorspace not in COLORSPACES:
+            raise ValueError(f"Unknown colour space `{colorspace}`")
+        self.options: Dict = dict(dpi=dpi, colorspace=colorspace, fmt=fmt, quality=quality)
+        self.workers: int = workers
+        self.jobs_per_worker: int = jobs_per_worker
+
+    def _jobs(
+            self,
+            pdf_path: str,
+            scheme_string: str,
+            start_on: int,
+            numbering_start: int
+    ) -> List[Tuple[str, range, str, Dict]]:
+        with fitz.open(pdf_path) as doc:
+            n_pages = len(doc)
+        options = dict(self.options, numbering_start=numbering_start)
+        return [
+            (pdf_path, pages, scheme_string, options)
+            for pages in page_ranges(start_on, n_pages, self.workers * self.jobs_per_worker)
+        ]
+
+    def extract_many(
+            self,
+            pdfs: Iterable[Tuple[str, str]],
+            start_on: int = 0,
+            numbering_start: int = 0
+    ) -> Iterator[Tuple[str, List[str]]]:
+        """ Renders several PDFs with the same pool, yields each PDF with its page images once it is done
+
+        :param pdfs: Couples of (PDF path, name scheme of its pages, e.g. `book/f{}.jpg`)
+        :param start_on: First page to render
+        :param numbering_start: Number of the first page of a PDF (page index 0) in the name scheme
+        """
+        if self.workers <= 1:
+            for pdf_path, scheme_string in pdfs:
+                yield pdf_path, [
+                    page
+                    for job in self._jobs(pdf_path, scheme_string, start_on, numbering_start)
+                    for page in _render_job(job)
+                ]
+            return
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            pending = []
+            for pdf_path, scheme_string in pdfs:
+                jobs = self._jobs(pdf_path, scheme_string, start_on, numbering_start)
+                pending.append((pdf_path, [executor.submit(_render_job, job) for job in jobs]))
+            for pdf_path, futures in pending:
+                yield pdf_path, [page for future in futures for page in future.result()]
+
+    def extract(
+            self,
+            pdf_path: str,
+            scheme_string: str,
+            start_on: int = 0,
+            numbering_start: int = 0
+    ) -> List[str]:
+        """ Renders a PDF, see `extract_many` """
+        for _, pages in self.extract_many([(pdf_path, scheme_string)], start_on, numbering_start):
+            return pages
+        return []
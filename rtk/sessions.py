@@ -0,0 +1,264 @@
+# Std lib
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+# Non std lib
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def host_of(url: str) -> str:
+    """ Host part of [URL], used to share connections and limits between requests to the same server
+
+    >>> host_of("https://gallica.bnf.fr/ark:/12148/bpt6k/f1.highres")
+    'gallica.bnf.fr'
+    """
+    return urlsplit(url).netloc.lower()
+
+
+# Responses worth retrying: the server is overloaded or asks to slow down
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(requests.RequestException):
+    """ Raised instead of sending a request to a host that failed too many times in a row """
+
+
+def retry_after(response: Optional[requests.Response]) -> Optional[float]:
+    """ Delay in seconds asked by the `Retry-After` header of [RESPONSE], if any
+
+    >>> response = requests.Response()
+    >>> response.headers["Retry-After"] = "120"
+    >>> retry_after(response)
+    120.0
+    >>> response.headers["Retry-After"] = "Wed, 21 Oct 2015 07:28:00 GMT"
+    >>> retry_after(response)
+    0.0
+    """
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HostLimiter:
+    """ Token bucket and circuit breaker of a single host, shared by every thread requesting it.
+
+    - Requests take a token, tokens come back at [RATE] per second up to [BURST].
+    - A failure pauses the whole host for the backoff (or `Retry-After`) delay, not only the request which failed.
+    - After [FAILURES] failures in a row, the circuit opens: requests fail at once with `CircuitOpenError` during
+      [COOLDOWN] seconds, then a single request is let through to test the host again.
+    """
+    def __init__(self, rate: float, burst: int, failures: int, cooldown: float):
+        self.rate: float = rate
+        self.burst: int = burst
+        self.failures: int = failures
+        self.cooldown: float = cooldown
+        self._tokens: float = burst
+        self._updated: float = time.monotonic()
+        self._paused_until: float = 0.
+        self._consecutive_failures: int = 0
+        self._open_until: Optional[float] = None
+        self._trial: bool = False
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """ Waits for a token, raises `CircuitOpenError` when the circuit is open """
+        trial = False
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if self._open_until is not None and not trial:
+                    if now < self._open_until or self._trial:
+                        raise CircuitOpenError(f"Too many failures in a row, host paused for {self.cooldown}s")
+                    self._trial = trial = True  # Half open: this request tests the host
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def success(self) -> None:
+        with self._lock:
+            self._consecutive_failures = 0
+            self._open_until = None
+            self._trial = False
+
+    def release(self) -> None:
+        """ Gives up a request that tells nothing about the host (e.g. an invalid URL) """
+        with self._lock:
+            self._trial = False
+
+    def failure(self, delay: float) -> None:
+        """ Pauses the host for [DELAY] seconds and opens the circuit after too many failures """
+        with self._lock:
+            self._consecutive_failures += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            if self._trial or self._consecutive_failures >= self.failures:
+                self._open_until = time.monotonic() + self.cooldown
+                self._trial = False
+
+
+class RateLimiter:
+    """ Per host rate limiting with exponential backoff, jitter and `Retry-After` support
+
+    :param rate: Requests per second sent to a host
+    :param burst: Requests sent at once to a host after an idle period (Default: [RATE])
+    :param rates: Rate of specific hosts, e.g. `{"gallica.bnf.fr": 2}`
+    :param retries: Number of attempts of a request before its last response (or error) is returned
+    :param backoff: First backoff delay in seconds, doubled at each attempt (with full jitter) up to [MAX_DELAY]
+    :param max_delay: Maximum delay between two attempts, `Retry-After` included
+    :param failures: Number of failures in a row opening the circuit of a host
+    :param cooldown: Time in seconds during which an open circuit rejects requests
+
+    >>> RateLimiter(retries=0)
+    Traceback (most recent call last):
+     ...
+    ValueError: A request requires at least one attempt (retries=0)
+    """
+    def __init__(
+            self,
+            rate: float = 10.,
+            burst: Optional[int] = None,
+            rates: Optional[Dict[str, float]] = None,
+            retries: int = 10,
+            backoff: float = 2.,
+            max_delay: float = 300.,
+            failures: int = 20,
+            cooldown: float = 600.
+    ):
+        if retries < 1:
+            raise ValueError(f"A request requires at least one attempt (retries={retries})")
+        self.rate: float = rate
+        self.burst: Optional[int] = burst
+        self.rates: Dict[str, float] = rates or {}
+        self.retries: int = retries
+        self.backoff: float = backoff
+        self.max_delay: float = max_delay
+        self.failures: int = failures
+        self.cooldown: float = cooldown
+        self._hosts: Dict[str, HostLimiter] = {}
+        self._lock = threading.Lock()
+
+    def host(self, url: str) -> HostLimiter:
+        host = host_of(url)
+        with self._lock:
+            if host not in self._hosts:
+                rate = self.rates.get(host, self.rate)
+                self._hosts[host] = HostLimiter(
+                    rate=rate, burst=self.burst or max(1, int(rate)), failures=self.failures, cooldown=self.cooldown
+                )
+            return self._hosts[host]
+
+    def delay(self, attempt: int, response: Optional[requests.Response] = None) -> float:
+        """ Delay before retrying after [ATTEMPT] failed attempts: `Retry-After` if given, exponential backoff with
+        full jitter otherwise """
+        asked = retry_after(response)
+        if asked is not None:
+            return min(asked, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.backoff * 2 ** attempt))
+
+
+class SessionPool:
+    """ One `requests.Session` per host, so that connections (and TLS handshakes) are reused between requests to the
+    same library server instead of opening a connection per page. The connection pool of a session is thread safe:
+    threads downloading from the same host share it.
+
+    >>> pool = SessionPool(connections=4)
+    >>> pool.session("https://gallica.bnf.fr/a") is pool.session("https://gallica.bnf.fr/b")
+    True
+    >>> pool.session("https://gallica.bnf.fr/a") is pool.session("https://www.e-rara.ch/a")
+    False
+
+    With a [LIMITER], requests are rate limited per host and retried when the server is overloaded
+    (`RETRY_STATUSES`) or the connection fails.
+
+    :param connections: Maximum number of connections kept open per host, should match the number of requests in
+        flight to a host
+    :param headers: Headers sent with every request
+    :param limiter: Rate limiter shared by the requests of the pool
+    :param timeout: Default timeout of requests, in seconds
+    """
+    def __init__(
+            self,
+            connections: int = 10,
+            headers: Optional[Dict[str, str]] = None,
+            limiter: Optional[RateLimiter] = None,
+            timeout: Optional[float] = 120.
+    ):
+        self.connections: int = connections
+        self.headers: Dict[str, str] = headers or {}
+        self.limiter: Optional[RateLimiter] = limiter
+        self.timeout: Optional[float] = timeout
+        self._sessions: Dict[str, requests.Session] = {}
+        self._lock = threading.Lock()
+
+    def session(self, url: str) -> requests.Session:
+        """ Session of the host of [URL], created on first use """
+        host = host_of(url)
+        with self._lock:
+            if host not in self._sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.connections)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers.update(self.headers)
+                self._sessions[host] = session
+            return self._sessions[host]
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """ Sends a request through the session (and the limiter) of the host of [URL]. Once retries are exhausted,
+        the last response is returned, or its connection error raised """
+        kwargs.setdefault("timeout", self.timeout)
+        session = self.session(url)
+        if self.limiter is None:
+            return session.request(method, url, **kwargs)
+
+        host = self.limiter.host(url)
+        for attempt in range(self.limiter.retries):
+            host.acquire()
+            try:
+                response = session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as E:
+                delay = self.limiter.delay(attempt)
+                host.failure(delay)
+                if attempt + 1 == self.limiter.retries:
+                    raise E
+                print(f"{E} while requesting {url}, retrying in {delay:.0f}s")
+                continue
+            except Exception as E:
+                host.release()
+                raise E
+            if response.status_code not in RETRY_STATUSES:
+                host.success()
+                return response
+            delay = self.limiter.delay(attempt, response)
+            host.failure(delay)
+            if attempt + 1 < self.limiter.retries:
+                response.close()  # Gives the connection back to the pool, even for streamed responses
+                print(f"HTTP code {response.status_code} while requesting {url}, retrying in {delay:.0f}s")
+        return response
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url: str, **kwargs) -> requests.Response:
+        return self.request("HEAD", url, **kwargs)
+
+    def close(self) -> None:
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
@@ -1,27 +1,34 @@
 import os
 import pathlib
 import subprocess
-import signal
 import csv
 import re
+import math
+import time
+import queue
+import threading
 from functools import partial
-from typing import Dict, Union, Tuple, List, Optional, Callable, Literal
-from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Union, Tuple, List, Optional, Callable, Literal, Set, Iterator
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from xml.sax import saxutils
 from collections import defaultdict
-from itertools import repeat
 # Non Std Lib
-import requests
 import tqdm
 import lxml.etree as ET
 # Local
 from rtk import utils
 from rtk import mets_utils
+from rtk import engines
+from rtk.ledger import Ledger
+from rtk.rasterize import PDFRasterizer
 
 
 InputType = Union[str, Tuple[str, str]]
 InputListType = Union[List[str], List[Tuple[str, str]]]
 DownstreamCheck = Optional[Callable[[InputType], bool]]
+# Sent through the queues of a stream when there is nothing more to process
+STREAM_END = object()
 
 
 def _sbmsg(msg) -> str:
@@ -33,6 +40,9 @@ class Task:
                  input_files: InputListType,
                  command: Optional[str] = None,
                  multiprocess: Optional[int] = None,
+                 ledger: Optional[Ledger] = None,
+                 backend: Literal["thread", "process"] = "thread",
+                 chunksize: Optional[int] = None,
                  **options
                  ):
         """
@@ -40,12 +50,22 @@ class Task:
         :param input_files: Name of the input files
         :param command: Replace input file by `$`, eg. `wget $ > $.txt`
         :param multiprocess: Number of process to use (default = 1)
+        :param ledger: Ledger recording processed pages, consulted by `check()` before the file system
+        :param backend: Pool used by tasks relying on `_map`. Use `process` for CPU-bound tasks holding the GIL
+            (lxml parsing, XPath, XSLT)
+        :param chunksize: Number of inputs sent at once to a worker process (Default: a quarter of a worker share)
         :param options: Task specific options
         """
         self.input_files: InputListType = input_files
         self.command: Optional[str] = command
         self._checked_files: Dict[InputType, bool] = {}
         self.workers: int = multiprocess or 1
+        self.ledger: Optional[Ledger] = ledger
+        self.stage: str = type(self).__name__
+        if backend not in {"thread", "process"}:
+            raise ValueError(f"Unknown backend `{backend}`")
+        self.backend: str = backend
+        self.chunksize: Optional[int] = chunksize
 
     def check(self) -> bool:
         raise NotImplementedError
@@ -64,6 +84,26 @@ class Task:
     def _process(self, inputs: InputListType) -> bool:
         raise NotImplementedError
 
+    def _map(self, function: Callable, inputs: InputListType) -> Iterator:
+        """ Maps [FUNCTION] over [INPUTS] in order, using the backend of the task. With the process backend, the
+        function must be picklable (module-level function or partial of one) and inputs are sent by chunks.
+        """
+        if self.backend == "process":
+            chunksize = self.chunksize or max(1, math.ceil(len(inputs) / (self.workers * 4)))
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                yield from executor.map(function, inputs, chunksize=chunksize)
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                yield from executor.map(function, inputs)
+
+    def stream(self, source: queue.Queue, sink: Optional[queue.Queue] = None) -> None:
+        """ Processes inputs as they arrive in [SOURCE] until `STREAM_END` is received, and puts each output into
+        [SINK] as soon as it is produced. Inputs that `check()` found processed are forwarded as is.
+
+        Used by `rtk.pipeline.StreamingPipeline`.
+        """
+        raise NotImplementedError
+
     @property
     def output_files(self) -> List[str]:
         raise NotImplementedError
@@ -146,21 +186,17 @@ class DownloadIIIFImageTask(Task):
         try:
             with ThreadPoolExecutor(max_workers=self.workers) as executor:
                 bar = tqdm.tqdm(total=len(inputs), desc=_sbmsg("Downloading..."))
-                for file in executor.map(
+                for result in executor.map(
                     utils.simple_args_kwargs_wrapper(utils.download_iiif_image, options=options),
                     [(file[0], self.rename_download(file)) for file in inputs]
                 ):  # urls=[list of url]
                     bar.update(1)
-                    if file:
-                        done.append(file)
+                    if result:
+                        done.append(result.target)
         except KeyboardInterrupt:
             bar.close()
-            print("Download manually interrupted, removing partial JPGs")
-            for url, directory, fname in inputs:
-                if url not in done:
-                    tgt = self.rename_download((url, directory, fname))
-                    if os.path.exists(tgt):
-                        os.remove(tgt)
+            # JPGs are only written once complete, partial downloads (.part) are resumed by the next run
+            print("Download manually interrupted")
         self._output_files.extend(done)
         return True
 
@@ -168,38 +204,75 @@ class DownloadIIIFImageTask(Task):
 class ExtractPDFTask(Task):
     """ Extract JPG from PDFs
 
+    Pages of each PDF are rendered by `multiprocess` processes (See `rtk.rasterize.PDFRasterizer`)
+
+    With a ledger, the page count of each PDF and its completion are recorded along its size and mtime: later checks
+    confirm an unchanged, extracted PDF with a single stat, without opening it or looking for its pages.
+
     :param output_dir: Path to the directory containing the output of the PDF extraction
     :param start_on: Page to start the extraction from. Some PDF have added prefaces, use this for ignoring them.
+    :param dpi: Resolution of the images
+    :param colorspace: Colour space of the images (rgb, gray)
+    :param fmt: Format of the images (jpg, png...)
+    :param quality: JPG quality
     """
     def __init__(
             self,
             *args,
             output_dir: Optional[str] = None,
             start_on: int = 0,
+            dpi: int = 300,
+            colorspace: Literal["rgb", "gray"] = "rgb",
+            fmt: str = "jpg",
+            quality: int = 95,
             **kwargs):
         super(ExtractPDFTask, self).__init__(*args, **kwargs)
         self._output_files: List[str] = []
         self._output_dir: str = output_dir
         self._start_on: int = start_on
+        self._fmt: str = fmt
+        self._nb_pages: Dict[str, int] = {}
+        self.rasterizer: PDFRasterizer = PDFRasterizer(
+            dpi=dpi, colorspace=colorspace, fmt=fmt, quality=quality, workers=self.workers
+        )
 
     def _get_scheme(self, pdf_path):
-        return utils.pdf_name_scheme(pdf_path, output_dir=self._output_dir)
+        return utils.pdf_name_scheme(pdf_path, output_dir=self._output_dir, extension=self._fmt)
+
+    def _record(self, pdf_path: str, nb_pages: int, status: str = Ledger.DONE) -> Dict:
+        stat = os.stat(pdf_path)
+        return dict(page=pdf_path, status=status, stat=False, meta=dict(
+            size=stat.st_size, mtime=stat.st_mtime, pages=nb_pages,
+            start_on=self._start_on, scheme=self._get_scheme(pdf_path)
+        ))
 
     def check(self) -> bool:
         all_done: bool = True
         pdfs_images: Dict[str, List[str]] = {}
+        entries = self.ledger.entries(self.stage) if self.ledger is not None else {}
+        records = []
         for single_pdf_path in tqdm.tqdm(
                 self.input_files,
                 desc=_sbmsg("Checking prior processed documents"),
                 total=len(self.input_files)
         ):
-            pdf_nb_pages = utils.pdf_get_nb_pages(single_pdf_path)
             scheme = self._get_scheme(single_pdf_path)
+            entry = entries.get(single_pdf_path)
+            stat = os.stat(single_pdf_path)
+            known = entry is not None and entry.meta is not None \
+                and (entry.meta["size"], entry.meta["mtime"]) == (stat.st_size, stat.st_mtime)
+            if known and self.ledger.is_done(entry) \
+                    and (entry.meta["start_on"], entry.meta["scheme"]) == (self._start_on, scheme):
+                self._checked_files[single_pdf_path] = True
+                self._output_files.extend(scheme.format(page) for page in range(self._start_on, entry.meta["pages"]))
+                continue
+            pdf_nb_pages = entry.meta["pages"] if known else utils.pdf_get_nb_pages(single_pdf_path)
+            self._nb_pages[single_pdf_path] = pdf_nb_pages
             pdfs_images[single_pdf_path] = []
+            self._checked_files[single_pdf_path] = True
             for page in range(self._start_on, pdf_nb_pages):
                 single_page_path = scheme.format(page)
                 if os.path.exists(single_page_path):
-                    self._checked_files[single_pdf_path] = True
                     pdfs_images[single_pdf_path].append(single_page_path)
                 else:
                     self._checked_files[single_pdf_path] = False
@@ -207,6 +280,11 @@ class ExtractPDFTask(Task):
                     break
             if self._checked_files[single_pdf_path]:
                 self._output_files.extend(pdfs_images[single_pdf_path])
+                records.append(self._record(single_pdf_path, pdf_nb_pages))
+            elif not known:  # Keeps the page count for the next check
+                records.append(self._record(single_pdf_path, pdf_nb_pages, status="pending"))
+        if self.ledger is not None:
+            self.ledger.record_many(self.stage, records)
         return all_done
 
     @property
@@ -214,13 +292,15 @@ class ExtractPDFTask(Task):
         return self._output_files
 
     def _process(self, inputs: InputListType) -> bool:
-        tp = ThreadPoolExecutor(self.workers)
         bar = tqdm.tqdm(desc=_sbmsg(f"Extract PDF images command"), total=len(inputs))
 
-        for fname in tp.map(
-                partial(utils.pdf_extract, scheme_string=self._get_scheme, start_on=self._start_on),
-                inputs):
+        for pdf_path, fname in self.rasterizer.extract_many(
+                [(pdf_path, self._get_scheme(pdf_path)) for pdf_path in inputs],
+                start_on=self._start_on):
             self._output_files.extend(fname)
+            if self.ledger is not None:
+                nb_pages = self._nb_pages.get(pdf_path) or utils.pdf_get_nb_pages(pdf_path)
+                self.ledger.record_many(self.stage, [self._record(pdf_path, nb_pages)])
             bar.update(1)
         bar.close()
         return True
@@ -277,16 +357,14 @@ class DownloadGallicaPDF(Task):
         return self._output_files
 
     @staticmethod
-    def download_pdf(manifest_and_target_and_length: Tuple[str, str, int]) -> str:
+    def download_pdf(manifest_and_target_and_length: Tuple[str, str, int]) -> Optional[str]:
         man, targ, length = manifest_and_target_and_length
         ark = DownloadGallicaPDF.ark(man)
-        resp = requests.get(DownloadGallicaPDF.SCHEME_ADDRESS.format(
+        result = utils.download(DownloadGallicaPDF.SCHEME_ADDRESS.format(
             ark=ark,
             length=length
-        ))
-        with open(targ, "wb") as f:
-            f.write(resp.content)
-        return targ
+        ), targ)
+        return result.target if result else None
 
     def check(self) -> bool:
         all_done: bool = True
@@ -308,7 +386,8 @@ class DownloadGallicaPDF(Task):
                 for file in inputs
             ]):  # urls=[list of url]
                 bar.update(1)
-                self._output_files.append(file)
+                if file:
+                    self._output_files.append(file)
         return True
 
 
@@ -319,6 +398,8 @@ class DownloadIIIFManifestTask(Task):
 
     :param input_files: List of manifests
     :param manifest_as_directory: Boolean that uses the manifest filename (can be a function) as a directory container
+    :param head_check: Checks the format of the images (See `utils.cleverer_manifest_parsing`), once per image
+        service profile and host for all the manifests of the task
 
     """
     def __init__(
@@ -327,11 +408,14 @@ class DownloadIIIFManifestTask(Task):
             naming_function: Optional[Callable[[str], str]] = None,
             output_directory: Optional[str] = None,
             custom_headers: Optional[Dict[str, str]] = None,
+            head_check: bool = False,
             **kwargs):
         super(DownloadIIIFManifestTask, self).__init__(*args, **kwargs)
         self.naming_function = naming_function or utils.string_to_hash
         self.output_directory = output_directory or "."
         self._custom_headers: Dict[str, str] = custom_headers or {}
+        self.head_check: bool = head_check
+        self._service_cache: utils.ServiceFormatCache = utils.ServiceFormatCache()
 
     def rename_download(self, file: InputType) -> str:
         return os.path.join(self.output_directory, utils.change_ext(self.naming_function(file), "csv"))
@@ -381,7 +465,12 @@ class DownloadIIIFManifestTask(Task):
         with ThreadPoolExecutor(max_workers=self.workers) as executor:
             bar = tqdm.tqdm(total=len(inputs), desc=_sbmsg("Downloading..."))
             for file in executor.map(
-                utils.simple_args_kwargs_wrapper(utils.download_iiif_manifest, options=self._custom_headers),
+                utils.simple_args_kwargs_wrapper(
+                    utils.download_iiif_manifest,
+                    options=self._custom_headers,
+                    head_check=self.head_check,
+                    cache=self._service_cache
+                ),
                 [(file, self.rename_download(file)) for file in inputs]):  # urls=[list of url]
                 bar.update(1)
                 if file:  # Ensure we downloaded the file
@@ -393,6 +482,17 @@ class KrakenLikeCommand(Task):
     """ Runs a Kraken Like command (Kraken, YALTAi)
 
     KrakenLikeCommand expect `$out` in its command
+
+    :param engine: Instead of spawning the CLI for each batch, keeps `multiprocess` worker processes alive with the
+        models loaded once (See `rtk.engines`)
+    :param engine_factory: Picklable callable returning the `rtk.engines.Engine` used in engine mode
+    :param chunk_size: Number of pages a worker pulls from the shared queue at once (Default: 1 page with the engine,
+        about a quarter of a worker share with the CLI, as each call reloads the models)
+    :param max_time_per_op: Maximum time in seconds for processing a single page before the run is stopped
+    :param quarantine: Path to a text file listing the pages that failed on their own. They are skipped by later runs
+        (remove them from the file to retry them)
+    :param content_stage: Stage of the ledger counting the lines of the outputs (e.g. `AltoPostProcessCommand`), read
+        by `check_content` instead of parsing the outputs, unless they were written again after this stage
     """
     def __init__(
             self,
@@ -402,6 +502,11 @@ class KrakenLikeCommand(Task):
             allow_failure: bool = True,
             check_content: bool = False,
             max_time_per_op: int = 60,  # Seconds
+            engine: bool = False,
+            engine_factory: Optional[engines.EngineFactory] = None,
+            chunk_size: Optional[int] = None,
+            quarantine: Optional[str] = None,
+            content_stage: Optional[str] = None,
             **kwargs):
         super(KrakenLikeCommand, self).__init__(*args, **kwargs)
         self.command: List[str] = [x for x in self.command if x]
@@ -411,7 +516,20 @@ class KrakenLikeCommand(Task):
         self._output_files: List[str] = []
         self.max_time_per_op: int = max_time_per_op
         self.desc: str = desc
-        print(" ".join(self.command))
+        self.engine: bool = engine
+        self._engine_factory: Optional[engines.EngineFactory] = engine_factory
+        self.chunk_size: Optional[int] = chunk_size
+        self.worker_stats: Dict[int, Dict[str, float]] = {}
+        self.quarantine: Optional[str] = quarantine
+        self.quarantined: Set[str] = set()
+        self.content_stage: Optional[str] = content_stage
+        self._lock = threading.Lock()
+        self._alone_lock = threading.Lock()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_size: int = self.workers
+        if self.engine and self._engine_factory is None:
+            raise ValueError(f"No engine available for {self.desc}")
+        print(" ".join(self.command) if not self.engine else f"[Engine] {self.desc}")
         if "R" not in self.command:
             raise NameError("R is missing in the Kraken-like command (Required for xargs)")
 
@@ -429,92 +547,323 @@ class KrakenLikeCommand(Task):
     def pbar_parsing(input_string: str) -> List[str]:
         raise NotImplementedError
 
+    def _load_quarantine(self) -> None:
+        if self.quarantine and os.path.exists(self.quarantine):
+            with open(self.quarantine) as f:
+                self.quarantined.update(line.strip() for line in f if line.strip())
+
+    def _quarantine_page(self, inp: str) -> None:
+        """ Records a page that fails on its own, so that it is not retried on every run """
+        print(f"Quarantining {inp}")
+        with self._lock:
+            self.quarantined.add(inp)
+            if self.quarantine:
+                with open(self.quarantine, "a") as f:
+                    f.write(inp + "\n")
+
     def check(self) -> bool:
         all_done: bool = True
+        self._load_quarantine()
+        entries = self.ledger.entries(self.stage) if self.ledger is not None else {}
+        contents = self.ledger.entries(self.content_stage) \
+            if self.ledger is not None and self.check_content and self.content_stage else {}
+        records = []
         for inp in tqdm.tqdm(
                 self.input_files,
                 desc=_sbmsg("Checking prior processed documents"),
                 total=len(self.input_files)
         ):
             out = self.rename(inp)
-            if os.path.exists(out):
-                self._checked_files[inp] = not self.check_content or utils.check_content(out)
+            entry = entries.get(inp)
+            content = contents.get(out)
+            if inp in self.quarantined:
+                self._checked_files[inp] = True
+            elif self.ledger is not None and self.ledger.is_done(entry) and (
+                    not self.check_content or entry.lines is not None):
+                self._checked_files[inp] = not self.check_content or utils.content_ratio_reached(
+                    entry.text_lines, entry.lines)
+            elif self.ledger is not None and self.ledger.is_done(content) and content.lines is not None and (
+                    entry is None or (content.mtime or 0) >= (entry.mtime or 0)):
+                # Counted by the content stage since this task last wrote the output
+                self._checked_files[inp] = utils.content_ratio_reached(content.text_lines, content.lines)
+            elif os.path.exists(out):
+                if self.check_content and self.ledger is None:
+                    # Nothing to record: the check stops as soon as the result is known
+                    self._checked_files[inp] = utils.check_content(out)
+                elif self.check_content:
+                    stats = utils.alto_content_stats(out)
+                    self._checked_files[inp] = stats is not None and utils.content_ratio_reached(*stats)
+                    if stats is not None:
+                        records.append(dict(page=inp, output=out, text_lines=stats[0], lines=stats[1]))
+                else:
+                    self._checked_files[inp] = True
+                    records.append(dict(page=inp, output=out))
             else:
                 self._checked_files[inp] = False
                 all_done = False
-        self._output_files.extend([self.rename(inp) for inp, status in self._checked_files.items() if status])
+        if self.ledger is not None:
+            self.ledger.record_many(self.stage, records)
+        if self.quarantined:
+            print(_sbmsg(f"{len(self.quarantined)} quarantined documents are ignored (See {self.quarantine})"))
+        self._output_files.extend([
+            self.rename(inp)
+            for inp, status in self._checked_files.items()
+            if status and inp not in self.quarantined
+        ])
         return all_done
 
-    def _process(self, inputs: InputListType) -> bool:
-        """ Use parallel """
-        def work(input_list: List[str], pbar) -> List[str]:
-            cmd = []
-            for x in self.command:
-                if x != "R":
-                    cmd.append(x)
-                else:
-                    cmd.extend([
-                        element
-                        for mapped_list in map(self.input_format, input_list)
-                        for element in mapped_list
-                    ])
+    def _new_pool(self, size: Optional[int] = None) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=size or self._pool_size,
+            initializer=engines.init_worker,
+            initargs=(self._engine_factory, )
+        )
+
+    def _run_engine(self, input_list: List[str], alone: bool = False) -> Tuple[List[str], bool]:
+        """ Process a chunk with the engine loaded in one of the long-lived worker processes
 
-            # This allows to control the number of threads used in a subprocess
-            my_env = os.environ.copy()
-            my_env["OMP_NUM_THREADS"] = "1"
-            # The following values are necessary for parsing output
-            my_env["LINES"] = "40"
-            my_env["COLUMNS"] = "300"
-
-            out = []
-            
-            proc = subprocess.Popen(
-                cmd,
-                text=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                env=my_env,
-                preexec_fn=lambda: signal.alarm(len(input_list)*self.max_time_per_op),
-            )
-
-            try:
-                for line in iter(proc.stdout.readline, ""):
-                    for element in self.pbar_parsing(line):
-                        out.append(element)
-                        pbar.update(1)
-                        break
-                    if len(set(out)) == len(set(input_list)):
-                        break
-               
-                return_code = proc.wait()
-             
-                if proc.returncode == 1:
-                    print("Error detected in subprocess...")
-                    print(proc.stdout.read())
-                    print(proc.stderr.read())
-                    print("Stopped process")
-                    if not self.allow_failure:
-                        raise InterruptedError
-            except subprocess.TimeoutExpired as te:
+        :param alone: Runs the chunk in a dedicated worker, one chunk at a time, so that it can only fail because of
+            its own pages: when a worker dies, every page in flight on the shared pool fails with it
+        :returns: Outputs written and whether the run failed
+        """
+        if alone:
+            with self._alone_lock:
+                pool = self._new_pool(1)
                 try:
-                    print(proc.stderr.read())
+                    return self._submit(pool, input_list)
+                finally:
+                    pool.shutdown(cancel_futures=True)
+        return self._submit(self._pool, input_list)
+
+    def _submit(self, pool: ProcessPoolExecutor, input_list: List[str]) -> Tuple[List[str], bool]:
+        try:
+            out = pool.submit(
+                engines.run_worker,
+                [(inp, self.rename(inp)) for inp in input_list],
+                max_time_per_op=self.max_time_per_op
+            ).result()
+        except BrokenProcessPool:
+            print(f"Engine worker died while processing {len(input_list)} documents")
+            with self._lock:
+                if self._pool is pool:
+                    print("Restarting the pool...")
+                    # Joins the thread managing the broken pool before it is released
+                    pool.shutdown(cancel_futures=True)
+                    self._pool = self._new_pool()
+            return [], True
+        except Exception as E:
+            print(f"Error detected in engine: {E}")
+            return [], True
+        return out, len(out) != len(input_list)
+
+    def _run_command(self, input_list: List[str], pbar: tqdm.tqdm) -> Tuple[List[str], bool]:
+        """ Process a chunk with a new CLI subprocess. The subprocess is killed if no page is finished for
+        `max_time_per_op` seconds.
+
+        :returns: Outputs written and whether the run failed
+        """
+        cmd = []
+        for x in self.command:
+            if x != "R":
+                cmd.append(x)
+            else:
+                cmd.extend([
+                    element
+                    for mapped_list in map(self.input_format, input_list)
+                    for element in mapped_list
+                ])
+
+        # This allows to control the number of threads used in a subprocess
+        my_env = os.environ.copy()
+        my_env["OMP_NUM_THREADS"] = "1"
+        # The following values are necessary for parsing output
+        my_env["LINES"] = "40"
+        my_env["COLUMNS"] = "300"
+
+        out = []
+
+        proc = subprocess.Popen(
+            cmd,
+            text=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=my_env,
+        )
+
+        # Page-level timeout: the deadline is pushed back each time a page is done
+        deadline = [time.monotonic() + self.max_time_per_op]
+        timed_out = threading.Event()
+        finished = threading.Event()
+
+        def watchdog():
+            while not finished.wait(1):
+                if time.monotonic() > deadline[0]:
+                    timed_out.set()
                     proc.kill()
-                except Exception as E:
-                    return out
-                return out
+                    return
+
+        threading.Thread(target=watchdog, daemon=True).start()
+        try:
+            for line in iter(proc.stdout.readline, ""):
+                for element in self.pbar_parsing(line):
+                    out.append(element)
+                    pbar.update(1)
+                    deadline[0] = time.monotonic() + self.max_time_per_op
+                    break
+                if len(set(out)) == len(set(input_list)):
+                    break
+
+            proc.wait()
+        finally:
+            finished.set()
+
+        if timed_out.is_set():
+            print(f"Timeout detected in subprocess after {len(out)}/{len(input_list)} documents...")
+            return out, True
+        if proc.returncode != 0:
+            print("Error detected in subprocess...")
+            print(proc.stdout.read())
+            print(proc.stderr.read())
+            print("Stopped process")
+            return out, True
+        return out, False
+
+    def _run_chunk(self, input_list: List[str], pbar: tqdm.tqdm, alone: bool = False) -> List[str]:
+        """ Process a chunk and salvages it on failure: only the unfinished pages are retried, bisecting them until
+        the page making the run fail is isolated and quarantined. With the engine, a failing page is first retried
+        alone (See `_run_engine`), as it may only have been in flight when another page killed the worker. """
+        if self.engine:
+            out, failed = self._run_engine(input_list, alone=alone)
+            pbar.update(len(out))
+        else:
+            out, failed = self._run_command(input_list, pbar)
+        done = set(map(self.rename, out))
+        remaining = [inp for inp in input_list if self.rename(inp) not in done]
+        if not remaining:
+            return out
+        if len(input_list) == 1:
+            if self.engine and not alone:
+                print(f"Retrying {input_list[0]} alone...")
+                return out + self._run_chunk(input_list, pbar, alone=True)
+            self._quarantine_page(input_list[0])
+            pbar.update(1)
             return out
+        if not failed:
+            print(f"{len(remaining)} documents were not processed, retrying...")
+        mid = math.ceil(len(remaining) / 2)
+        for half in (remaining[:mid], remaining[mid:]):
+            if half:
+                out.extend(self._run_chunk(half, pbar))
+        return out
 
-        # Group inputs into the number of workers
-        total_texts = len(inputs)
-        inputs = utils.split_batches(inputs, self.workers)
+    def _default_chunk_size(self, total_texts: int) -> int:
+        # Each CLI call reloads the models, hence bigger chunks than with the engine
+        return self.chunk_size or (1 if self.engine else max(1, math.ceil(total_texts / (self.workers * 4))))
 
-        tp = ThreadPoolExecutor(len([batches for batches in inputs if len(batches)]))
-        bar = tqdm.tqdm(desc=_sbmsg(f"Processing {self.desc} command"), total=total_texts)
-        for gen in tp.map(work, inputs, repeat(bar)):
-            for elem in gen:
-                if isinstance(elem, str):
-                    self._output_files.append(elem)
-        bar.close()
+    def _run_workers(
+            self,
+            source: queue.Queue,
+            sink: Optional[queue.Queue],
+            nb_workers: int,
+            chunk_size: int,
+            bar: tqdm.tqdm
+    ) -> None:
+        """ Runs [NB_WORKERS] workers pulling up to [CHUNK_SIZE] pages at once from [SOURCE] until `STREAM_END` is
+        received. Outputs are put into [SINK] as soon as they are written. """
+        quarantined = len(self.quarantined)
+        if self.engine:
+            self._pool_size = nb_workers
+            self._pool = self._new_pool()
+
+        def next_chunk() -> List[str]:
+            chunk = []
+            inp = source.get()
+            while inp is not STREAM_END:
+                if self._checked_files.get(inp):  # Already processed, we only forward it
+                    if sink is not None and inp not in self.quarantined:
+                        sink.put(self.rename(inp))
+                    bar.update(1)
+                else:
+                    chunk.append(inp)
+                if len(chunk) >= chunk_size:
+                    return chunk
+                try:
+                    inp = source.get(block=not chunk)
+                except queue.Empty:
+                    return chunk
+            source.put(STREAM_END)  # Let the other workers know
+            return chunk
+
+        def worker(worker_id: int) -> Tuple[int, int, float]:
+            pages, busy = 0, .0
+            while True:
+                chunk = next_chunk()
+                if not chunk:
+                    return worker_id, pages, busy
+                start = time.perf_counter()
+                out = [elem for elem in self._run_chunk(chunk, bar) if isinstance(elem, str)]
+                busy += time.perf_counter() - start
+                pages += len(chunk)
+                self._output_files.extend(out)
+                if self.ledger is not None:
+                    done = set(map(self.rename, out))
+                    self.ledger.record_many(self.stage, [
+                        dict(page=inp, output=self.rename(inp))
+                        for inp in chunk
+                        if self.rename(inp) in done
+                    ])
+                if sink is not None:
+                    for elem in out:
+                        sink.put(self.rename(elem))
+
+        start = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(nb_workers) as tp:
+                stats = list(tp.map(worker, range(nb_workers)))
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown(cancel_futures=True)
+                self._pool = None
+            bar.close()
+        wall = time.perf_counter() - start
+
+        self.worker_stats = {
+            worker_id: {"pages": pages, "busy": busy, "utilisation": busy / (wall or 1)}
+            for worker_id, pages, busy in stats
+        }
+        for worker_id, stat in self.worker_stats.items():
+            print(_sbmsg(f"Worker {worker_id}: {stat['pages']} pages, busy {stat['busy']:.1f}s / {wall:.1f}s "
+                         f"({stat['utilisation']:.0%})"))
+        if len(self.quarantined) > quarantined and not self.allow_failure:
+            raise InterruptedError(f"{len(self.quarantined) - quarantined} documents failed and were quarantined")
+
+    def _process(self, inputs: InputListType) -> bool:
+        """ Use parallel: each worker pulls chunks from a shared queue until it is empty, so that a worker stuck on
+        dense pages does not hold back the pages that others could process """
+        source: queue.Queue = queue.Queue()
+        for inp in inputs:
+            source.put(inp)
+        source.put(STREAM_END)
+        chunk_size = self._default_chunk_size(len(inputs))
+        self._run_workers(
+            source,
+            sink=None,
+            nb_workers=min(self.workers, math.ceil(len(inputs) / chunk_size)),
+            chunk_size=chunk_size,
+            bar=tqdm.tqdm(desc=_sbmsg(f"Processing {self.desc} command"), total=len(inputs))
+        )
+        return True
+
+    def stream(self, source: queue.Queue, sink: Optional[queue.Queue] = None) -> None:
+        """ Processes pages as they arrive in [SOURCE]: with the CLI, a worker takes whatever is waiting in the queue,
+        up to `chunk_size` pages. """
+        self._run_workers(
+            source,
+            sink=sink,
+            nb_workers=self.workers,
+            chunk_size=self._default_chunk_size(len(self.input_files)),
+            bar=tqdm.tqdm(desc=_sbmsg(f"Streaming {self.desc} command"), total=len(self.input_files))
+        )
 
     def input_format(self, inp: str) -> List[str]:
         return ["-i",  inp, self.rename(inp)]
@@ -566,6 +915,13 @@ class YALTAiCommand(KrakenLikeCommand):
             output_format="xml",
             check_content=check_content,
             desc="YALTAi segmenter",
+            engine_factory=partial(
+                engines.YALTAiEngine,
+                yolo_model=yolo_model,
+                line_model=line_model,
+                device=device,
+                raise_on_error=bool(kwargs.get('raise_on_error'))
+            ),
             **kwargs
         )
 
@@ -601,6 +957,12 @@ class KrakenRecognizerCommand(KrakenLikeCommand):
             output_format="xml",
             check_content=check_content,
             desc="Kraken recognizer",
+            engine_factory=partial(
+                engines.KrakenRecognizerEngine,
+                model=model,
+                device=device,
+                raise_on_error=raise_on_error
+            ),
             **kwargs
         )
 
@@ -633,6 +995,13 @@ class KrakenSegAndRecCommand(KrakenLikeCommand):
         options = ""
         if raise_on_error:
             options += " --raise-on-error "
+        engine_factory = partial(
+            engines.KrakenSegAndRecEngine,
+            model=htr_model,
+            seg_model=seg_model,
+            device=device,
+            raise_on_error=raise_on_error
+        )
         seg_model = f"-i {seg_model}" if seg_model else "-bl"
         super(KrakenSegAndRecCommand, self).__init__(
             *args,
@@ -641,6 +1010,7 @@ class KrakenSegAndRecCommand(KrakenLikeCommand):
             output_format="xml",
             check_content=check_content,
             desc="Kraken recognizer",
+            engine_factory=engine_factory,
             **kwargs
         )
 
@@ -661,9 +1031,12 @@ class KrakenAltoCleanUpCommand(Task):
 
     def check(self) -> bool:
         all_done: bool = True
+        entries = self.ledger.entries(self.stage) if self.ledger is not None else {}
         for inp in tqdm.tqdm(
                 self.input_files, desc=_sbmsg("Checking prior processed documents"), total=len(self.input_files)):
-            if os.path.exists(inp):
+            if self.ledger is not None and self.ledger.is_done(entries.get(inp)):
+                self._checked_files[inp] = True
+            elif os.path.exists(inp):
                 # ToDo: Check XML or JSON is well-formed
                 self._checked_files[inp] = utils.check_kraken_filename(inp)
             else:
@@ -671,15 +1044,37 @@ class KrakenAltoCleanUpCommand(Task):
                 all_done = False
         return all_done
 
+    def _record(self, files: List[Optional[str]]) -> None:
+        if self.ledger is not None:
+            self.ledger.record_many(self.stage, [dict(page=file, output=file) for file in files if file])
+
     def _process(self, inputs: InputListType) -> bool:
         done = []
-        with ThreadPoolExecutor(max_workers=self.workers) as executor:
-            bar = tqdm.tqdm(total=len(inputs), desc=_sbmsg("Cleaning..."))
-            for file in executor.map(utils.clean_kraken_filename, inputs):  # urls=[list of url]
-                bar.update(1)
-                done.append(file)
+        bar = tqdm.tqdm(total=len(inputs), desc=_sbmsg("Cleaning..."))
+        for file in self._map(utils.clean_kraken_filename, inputs):  # urls=[list of url]
+            bar.update(1)
+            done.append(file)
+        bar.close()
+        self._record(done)
         return True
 
+    def stream(self, source: queue.Queue, sink: Optional[queue.Queue] = None) -> None:
+        bar = tqdm.tqdm(total=len(self.input_files), desc=_sbmsg("Streaming clean-up..."))
+        inp = source.get()
+        while inp is not STREAM_END:
+            if self._checked_files.get(inp):
+                file = inp
+            else:
+                file = utils.clean_kraken_filename(inp)
+                self._record([file])
+            if file is None:
+                print(f"Unable to clean-up {inp}")
+            elif sink is not None:
+                sink.put(file)
+            bar.update(1)
+            inp = source.get()
+        bar.close()
+
 
 class ClearFileCommand(Task):
     """ Remove files when they have been processed, useful for JPG
@@ -707,6 +1102,35 @@ class ClearFileCommand(Task):
         return True
 
 
+def _extract_zone_alto(file_and_target: Tuple[str, str], zones: Optional[List[str]], fmt: str) -> None:
+    input_file, target = file_and_target
+    content = utils.alto_zone_extraction(input_file, zones)
+    if content:
+        with open(target, "w") as f:
+            if fmt == "txt":
+                f.write("\n".join([
+                    line
+                    for zone in content
+                    for line in zone["lines"]
+                ]))
+            else:
+                text = "\n"
+                for zone in content:
+                    text += f"<div type='{zone['type']}'>\n"
+                    for line in zone["lines"]:
+                        text += f"    <seg><lb />{saxutils.escape(line)}</seg>\n"
+                    text += "</div>\n"
+                f.write(text)
+
+
+def _apply_xslt(file_and_target: Tuple[str, str], xsl_path: str) -> str:
+    """ Applies the XSLT, compiled once per worker """
+    file, target = file_and_target
+    doc = utils.get_xslt(xsl_path)(ET.parse(file))
+    doc.write(target)
+    return target
+
+
 class ExtractZoneAltoCommand(Task):
     """ This command takes an ALTO input and transforms it into a .txt file, only keeping the provided Zones.
     """
@@ -738,29 +1162,13 @@ class ExtractZoneAltoCommand(Task):
         return all_done
 
     def _process(self, inputs: InputListType) -> bool:
-        def custom_alto_zone_extraction(input_file):
-            content = utils.alto_zone_extraction(input_file, self.zones)
-            if content:
-                with open(self.rename(input_file), "w") as f:
-                    if self.fmt == "txt":
-                        f.write("\n".join([
-                            line
-                            for zone in content
-                            for line in zone["lines"]
-                        ]))
-                    else:
-                        text = "\n"
-                        for zone in content:
-                            text += f"<div type='{zone['type']}'>\n"
-                            for line in zone["lines"]:
-                                text += f"    <seg><lb />{saxutils.escape(line)}</seg>\n"
-                            text += "</div>\n"
-                        f.write(text)
-
-        with ThreadPoolExecutor(max_workers=self.workers) as executor:
-            bar = tqdm.tqdm(total=len(inputs), desc=_sbmsg("Cleaning..."))
-            for file in executor.map(custom_alto_zone_extraction, inputs):  # urls=[list of url]
-                bar.update(1)
+        bar = tqdm.tqdm(total=len(inputs), desc=_sbmsg("Cleaning..."))
+        for file in self._map(
+                partial(_extract_zone_alto, zones=self.zones, fmt=self.fmt),
+                [(file, self.rename(file)) for file in inputs]
+        ):  # urls=[list of url]
+            bar.update(1)
+        bar.close()
         return True
 
 
@@ -774,10 +1182,7 @@ class CleanUpAltoGlyphs(Task):
             **kwargs):
         super(CleanUpAltoGlyphs, self).__init__(*args, **kwargs)
         self.keep_string: bool = keep_string
-        self.xsl_path: str = os.path.join(
-            os.path.dirname(os.path.abspath(__file__)),
-            ("clean-up-alto.xsl" if keep_string else "clean-up-alto-without-string.xsl")
-        )
+        self.xsl_path: str = utils.glyph_cleanup_xslt_path(keep_string)
         self._output_files = []
 
     def rename(self, inp):
@@ -808,71 +1213,207 @@ class CleanUpAltoGlyphs(Task):
         return all_done
 
     def _process(self, inputs: InputListType) -> bool:
-        # Need to add batch capacities
-        def apply_xslt(batch_of_files: List[str], pbar: tqdm.tqdm) -> List[str]:
-            transform = ET.XSLT(ET.parse(self.xsl_path))
-            out = []
-            for file in batch_of_files:
-                try:
-                    doc = ET.parse(file)
-                    doc = transform(doc)
-                    doc.write(self.rename(file))
-                    out.append(self.rename(file))
-                except Exception as E:
-                    raise E
-                    print(E)
-            return out
-
-        # Group inputs into the number of workers
-        total_texts = len(inputs)
-        inputs = utils.split_batches(inputs, self.workers)
-
-        tp = ThreadPoolExecutor(len([batches for batches in inputs if len(batches)]))
         bar = tqdm.tqdm(
             desc=_sbmsg(f"Removing <Glyph> from ALTO" if self.keep_string else "Removing <String> from ALTO"),
-            total=total_texts
+            total=len(inputs)
         )
-
-        for gen in tp.map(apply_xslt, inputs, repeat(bar)):
-            for elem in gen:
-                if isinstance(elem, str):
-                    self._output_files.append(elem)
+        for elem in self._map(
+                partial(_apply_xslt, xsl_path=self.xsl_path),
+                [(file, self.rename(file)) for file in inputs]
+        ):
+            bar.update(1)
+            if isinstance(elem, str):
+                self._output_files.append(elem)
         bar.close()
 
         return True
 
 
+class AltoPostProcessCommand(Task):
+    """ Post-processes ALTO files with a single parse and a single atomic write per file: fixes the image filename
+    written by Kraken (as `KrakenAltoCleanUpCommand`), optionally removes glyphs (as `CleanUpAltoGlyphs`) and counts
+    the lines with text (as `utils.check_content`).
+
+    With a ledger, results are recorded so that later checks do not reopen the files. They are available in
+    `self.stats`.
+
+    :param strip_glyphs: Removes the glyphs information
+    :param keep_string: Keeps the String elements when removing glyphs
+    """
+    def __init__(
+            self,
+            *args,
+            strip_glyphs: bool = False,
+            keep_string: bool = True,
+            **kwargs):
+        super(AltoPostProcessCommand, self).__init__(*args, **kwargs)
+        self.strip_glyphs: bool = strip_glyphs
+        self.keep_string: bool = keep_string
+        self.stats: Dict[str, Dict[str, Union[bool, int]]] = {}
+
+    @property
+    def output_files(self) -> List[InputType]:
+        return self.input_files
+
+    def _is_done(self, status: Optional[Dict[str, Union[bool, int]]]) -> bool:
+        if not status or not status["filename_fixed"]:
+            return False
+        return not self.strip_glyphs or (status["glyphs_stripped"] and status["keep_string"] == self.keep_string)
+
+    def check(self) -> bool:
+        all_done: bool = True
+        entries = self.ledger.entries(self.stage) if self.ledger is not None else {}
+        records = []
+        for file in tqdm.tqdm(self.input_files, desc=_sbmsg("Checking prior processed documents")):
+            entry = entries.get(file)
+            if self.ledger is not None and self.ledger.is_done(entry) and self._is_done(entry.meta):
+                self.stats[file] = entry.meta
+                self._checked_files[file] = True
+                continue
+            status = utils.alto_postprocess_status(file, keep_string=self.keep_string) \
+                if os.path.exists(file) else None
+            self._checked_files[file] = self._is_done(status)
+            if self._checked_files[file]:
+                self.stats[file] = status
+                records.append(self._record(file, status))
+            else:
+                all_done = False
+        if self.ledger is not None:
+            self.ledger.record_many(self.stage, records)
+        return all_done
+
+    @staticmethod
+    def _record(file: str, status: Dict[str, Union[bool, int]]) -> Dict:
+        return dict(page=file, output=file, lines=status["lines"], text_lines=status["text_lines"], meta=status)
+
+    def _done(self, file: str, status: Optional[Dict[str, Union[bool, int]]]) -> bool:
+        if status is None:
+            print(f"Unable to post-process {file}")
+            return False
+        self.stats[file] = status
+        if self.ledger is not None:
+            self.ledger.record_many(self.stage, [self._record(file, status)])
+        return True
+
+    def _process(self, inputs: InputListType) -> bool:
+        bar = tqdm.tqdm(total=len(inputs), desc=_sbmsg("Post-processing ALTO..."))
+        for file, status in zip(inputs, self._map(
+                partial(utils.postprocess_alto, strip_glyphs=self.strip_glyphs, keep_string=self.keep_string),
+                inputs
+        )):
+            bar.update(1)
+            self._done(file, status)
+        bar.close()
+        return True
+
+    def stream(self, source: queue.Queue, sink: Optional[queue.Queue] = None) -> None:
+        bar = tqdm.tqdm(total=len(self.input_files), desc=_sbmsg("Streaming ALTO post-processing..."))
+        inp = source.get()
+        while inp is not STREAM_END:
+            if self._checked_files.get(inp) or self._done(inp, utils.postprocess_alto(
+                    inp, strip_glyphs=self.strip_glyphs, keep_string=self.keep_string)):
+                if sink is not None:
+                    sink.put(inp)
+            bar.update(1)
+            inp = source.get()
+        bar.close()
+
+
+def _package_group(
+        group_archive_images: Tuple[str, str, Optional[Dict[str, str]]],
+        deflate_level: int = 6
+) -> mets_utils.PackageReport:
+    group, archive, image_names = group_archive_images
+    return mets_utils.package_folder(group, archive, deflate_level=deflate_level, image_names=image_names)
+
+
 class METSBuilder(Task):
-    def __init__(self, input_files: List[str], target_prefix: Optional[str] = None):
+    """ Produces the METS.xml of each folder of the input files and zips each folder
+
+    Groups are packaged in parallel (`multiprocess` workers, processes by default), a report of each group (bytes
+    in, bytes out, time) is available in `self.reports`.
+
+    With a ledger, the image of each ALTO file is the page recorded by [IMAGE_STAGE], the ALTO files are then not
+    opened at all.
+
+    :param target_prefix: Directory of the archives
+    :param deflate_level: Compression level of the XML files (0-9), images are stored as is
+    :param image_stage: Stage of the ledger producing the ALTO files from the images
+    """
+    def __init__(
+            self,
+            input_files: List[str],
+            target_prefix: Optional[str] = None,
+            deflate_level: int = 6,
+            image_stage: str = "YALTAiCommand",
+            backend: Literal["thread", "process"] = "process",
+            **kwargs
+    ):
         self._target: Optional[str] = target_prefix
         if self._target:
             os.makedirs(self._target, exist_ok=True)
-        super().__init__(input_files=input_files)
+        super().__init__(input_files=input_files, backend=backend, **kwargs)
 
+        self.deflate_level: int = deflate_level
+        self.image_stage: str = image_stage
+        self.reports: Dict[str, mets_utils.PackageReport] = {}
         self._output_files = []
         self._groups: Dict[str, List[str]] = defaultdict(list)
         for file in input_files:
             self._groups[os.path.dirname(file)].append(file)
 
+    @property
+    def output_files(self) -> List[str]:
+        return self._output_files
+
+    def _archive_name(self, group: str) -> str:
+        folder = os.path.basename(group)
+        return f"{os.path.join(self._target, folder) or folder}-mets.zip"
+
     def check(self) -> bool:
-        """Currently, we rezip everything, simpler that processing zip """
-        self._checked_files = {
-            file: False
-            for file in self.input_files
-        }
-        return False
+        """ A group is processed when its archive holds every file of its folder, with the same size and
+        modification time (METS.xml included, it is only rewritten when its content changes) """
+        all_done = True
+        for group, files in tqdm.tqdm(self._groups.items(), desc=_sbmsg("Checking prior METS archives")):
+            archive = self._archive_name(group)
+            done = mets_utils.zip_changes(group, archive) == ([], [], [])
+            if done:
+                self._output_files.append(archive)
+            else:
+                all_done = False
+            for file in files:
+                self._checked_files[file] = done
+        return all_done
+
+    def _image_names(self) -> Dict[str, Dict[str, str]]:
+        """ Image of each ALTO file recorded in the ledger, by group """
+        images: Dict[str, Dict[str, str]] = defaultdict(dict)
+        if self.ledger is not None:
+            for page, entry in self.ledger.entries(self.image_stage).items():
+                # Later stages rewrite the ALTO files in place (post-processing, OCR), which does not change their
+                # image: the output is not checked against the file system
+                if entry.output and entry.status == Ledger.DONE:
+                    output = os.path.normpath(entry.output)
+                    images[os.path.dirname(output)][output] = page
+        return images
 
     def _process(self, inputs: InputListType) -> bool:
+        groups = list(dict.fromkeys(os.path.dirname(file) for file in inputs))
         bar = tqdm.tqdm(
             desc=_sbmsg(f"Processing documents into METS"),
-            total=len(self._groups)
+            total=len(groups)
         )
 
-        for group in self._groups:
-            mets_utils.produce_mets(group, exclude="METS.xml")
-            folder = os.path.basename(group)
-            mets_name = f"{os.path.join(self._target, folder) or folder}-mets.zip"
-            mets_utils.zip_folder(group, mets_name)
-            self._output_files.append(mets_name)
+        images = self._image_names()
+        for report in self._map(
+                partial(_package_group, deflate_level=self.deflate_level),
+                [(group, self._archive_name(group), images.get(os.path.normpath(group))) for group in groups]
+        ):
+            self.reports[report.archive] = report
+            self._output_files.append(report.archive)
             bar.update(1)
+            print(_sbmsg(
+                f"{report.archive}: {report.status}, {report.bytes_in / 2**20:.1f} MiB -> "
+                f"{report.bytes_out / 2**20:.1f} MiB in {report.seconds:.2f}s"
+            ))
         return True
@@ -1,8 +1,12 @@
 # Std lib
-from typing import Tuple, List, Optional, Dict, Union, Any, Callable
+from typing import Tuple, List, Optional, Dict, Union, Any, Callable, Iterator, NamedTuple
 import os
+import json
 import hashlib
+import threading
 import csv
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 # Non std lib
 import fitz  # PyMuPDF
@@ -11,7 +15,12 @@ import lxml.etree as ET
 import cases
 import unidecode
 from xml.sax.saxutils import escape
+# Local
+from rtk.sessions import SessionPool, RateLimiter, host_of
+from rtk.rasterize import PDFRasterizer
 
+# Shared by the download functions (and their threads): pooled connections and rate limits per host
+SESSIONS = SessionPool(limiter=RateLimiter())
 
 
 def split_batches(inputs: List[str], splits: int) -> List[List[str]]:
@@ -35,29 +44,110 @@ def split_batches(inputs: List[str], splits: int) -> List[List[str]]:
 
 
 
-def download(url: str, target: str, options: Optional[Dict[str, str]] = None) -> Optional[str]:
+class DownloadResult(NamedTuple):
+    """ Outcome of `download`, truthy when the file was saved
+
+    >>> bool(DownloadResult("https://a/b.jpg", "b.jpg", status=404, error="404 Client Error"))
+    False
+    """
+    url: str
+    target: str
+    status: Optional[int] = None
+    size: int = 0
+    resumed: bool = False
+    error: Optional[str] = None
+
+    def __bool__(self) -> bool:
+        return self.error is None
+
+
+def _expected_length(response: requests.Response) -> Optional[int]:
+    """ Full size of the file sent by [RESPONSE], when the server announces it """
+    if response.status_code == 206:
+        total = response.headers.get("Content-Range", "").rpartition("/")[2]
+        return int(total) if total.isdigit() else None
+    length = response.headers.get("Content-Length")
+    if length and length.isdigit() and not response.headers.get("Content-Encoding"):
+        return int(length)
+    return None
+
+
+def download(
+        url: str,
+        target: str,
+        options: Optional[Dict[str, str]] = None,
+        size: Optional[int] = None,
+        checksum: Optional[str] = None,
+        algorithm: str = "sha256",
+        chunk_size: int = 1 << 16
+) -> DownloadResult:
     """ Download the element at [URL] and saves it at [TARGET] using binary writing. [OPTIONS] are fed to the headers
 
+    The body is streamed to [TARGET].part, which is synced and renamed to [TARGET] once complete: [TARGET] is never
+    a truncated file. A .part left by an interrupted download is resumed with a Range request.
+
     :param url: A url
     :param target: A destination path
     :param options: A key-value dict for the request headers
-    :return: The path where the file was saved or None if the download failed.
+    :param size: Expected size in bytes, checked in addition to the size announced by the server
+    :param checksum: Expected hex digest of the file
+    :param algorithm: Hash algorithm of [CHECKSUM] (Any `hashlib` algorithm)
+    :param chunk_size: Size of the chunks written to disk
+    :return: The result of the download, false when it failed (see its `error`)
     """
     headers = {}
     headers.update(options or {})
-    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if os.path.dirname(target):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+    part_path = f"{target}.part"
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+    status = None
     try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        with open(target, 'wb') as handle:
-            handle.write(response.content)
-        return target
+        with SESSIONS.get(url, headers=headers, stream=True) as response:
+            status = response.status_code
+            if status == 416 and offset:  # The partial file is not a prefix of the current file
+                os.remove(part_path)
+                return download(url, target, options, size=size, checksum=checksum, algorithm=algorithm)
+            response.raise_for_status()
+            resumed = offset > 0 and status == 206  # Servers ignoring Range send the whole file with a 200
+            expected = _expected_length(response)
+            with open(part_path, "ab" if resumed else "wb") as handle:
+                for chunk in response.iter_content(chunk_size):
+                    handle.write(chunk)
+                handle.flush()
+                os.fsync(handle.fileno())
     except Exception as E:
         print(E)
-        return None
-
-
-def download_iiif_image(url: str, target: str, options: Optional[Dict[str, Union[str, int]]] = None) -> str:
+        written = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        return DownloadResult(url, target, status=status, size=written, error=str(E))
+
+    written = os.path.getsize(part_path)
+    error = None
+    if expected is not None and written < expected:
+        error = f"Incomplete download of {url}: {written} bytes out of {expected}"
+        return DownloadResult(url, target, status=status, size=written, resumed=resumed, error=error)
+    if size is not None and written != size:
+        error = f"{url} is {written} bytes, expected {size}"
+    elif checksum:
+        with open(part_path, "rb") as f:
+            digest = hashlib.file_digest(f, algorithm).hexdigest()
+        if digest != checksum.lower():
+            error = f"{url} has the {algorithm} {digest}, expected {checksum}"
+    if error:
+        print(error)
+        os.remove(part_path)  # Resuming a corrupted file would not fix it
+        return DownloadResult(url, target, status=status, size=written, resumed=resumed, error=error)
+    os.replace(part_path, target)
+    return DownloadResult(url, target, status=status, size=written, resumed=resumed)
+
+
+def download_iiif_image(
+        url: str,
+        target: str,
+        options: Optional[Dict[str, Union[str, int]]] = None
+) -> DownloadResult:
     """ Download the IIIF image at [URL] and saves it at [TARGET] using binary writing. [OPTIONS] are mostly fed to the
         headers except for `max_width` and `max_height` keys which are used for limiting the image size (instead of
         full size image). You cannot use max_width and max_height at the same time.
@@ -65,8 +155,9 @@ def download_iiif_image(url: str, target: str, options: Optional[Dict[str, Union
     :param url: A url
     :param target: A destination path
     :param options: A key-value dict for the request headers
-    :return: The path where the file was saved or None if the download failed.
+    :return: The result of the download, false when it failed
     """
+    options = options or {}
     if options.get("max_height"):
         url = url.replace("/full/full/", f"/full/,{options['max_height']}/")
     elif options.get("max_width"):
@@ -82,7 +173,14 @@ def download_iiif_image(url: str, target: str, options: Optional[Dict[str, Union
     )
 
 
-def download_iiif_manifest(url: str, target: str, options: Optional[Dict[str, str]] = None) -> Optional[str]:
+def download_iiif_manifest(
+        url: str,
+        target: str,
+        options: Optional[Dict[str, str]] = None,
+        head_check: bool = False,
+        cache: Optional["ServiceFormatCache"] = None,
+        workers: int = 8
+) -> Optional[str]:
     """ Download the element at [URL] and saves it at [TARGET] using plain-text writing. [OPTIONS] are fed to
         the headers. In case of failure, print the exception and return None. The manifest is read and the data is
         compiled as a CSV
@@ -90,13 +188,17 @@ def download_iiif_manifest(url: str, target: str, options: Optional[Dict[str, st
     :param url: A url
     :param target: A destination path
     :param options: A key-value dict for the request headers
+    :param head_check: Checks the format of the images of IIIF v2 manifests (See `cleverer_manifest_parsing`), each
+        service profile is checked once
+    :param cache: Cache of the service checks, shared with other manifests (Default: one per manifest)
+    :param workers: Number of canvases checked at the same time
     :return: The path where the file was saved or None if the download failed.
     """
     os.makedirs(os.path.dirname(target), exist_ok=True)
     headers = {}
     headers.update(options or {})
     try:
-        response = requests.get(url, headers=headers)
+        response = SESSIONS.get(url, headers=headers)
         response.raise_for_status()
         j = response.json()
     except Exception as E:
@@ -108,8 +210,14 @@ def download_iiif_manifest(url: str, target: str, options: Optional[Dict[str, st
         for idx, element in enumerate(j["items"]):
             rows.append([element["items"][0]["items"][0]["body"]["id"], dirname, f"f{idx}-"+clean_kebab(element["label"])])
     elif "sequences" in j:
-        for idx, canvas in enumerate(j["sequences"][0]["canvases"]):
-            elm = cleverer_manifest_parsing(canvas["images"][0])
+        canvases = j["sequences"][0]["canvases"]
+        parse = partial(cleverer_manifest_parsing, head_check=head_check, cache=cache or ServiceFormatCache())
+        if head_check:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                elms = list(executor.map(parse, [canvas["images"][0] for canvas in canvases]))
+        else:
+            elms = [parse(canvas["images"][0]) for canvas in canvases]
+        for idx, (canvas, elm) in enumerate(zip(canvases, elms)):
             if elm:
                 rows.append([elm, dirname, f"f{idx}-"+clean_kebab(canvas["label"])])
 
@@ -120,29 +228,97 @@ def download_iiif_manifest(url: str, target: str, options: Optional[Dict[str, st
     return url
 
 
+ALTO_NS = "http://www.loc.gov/standards/alto/ns-v4#"
+
+
+def _iter_string_contents(filepath: str) -> Iterator[bool]:
+    """ Streams the String elements of an ALTO file that have a CONTENT attribute, and yields whether the CONTENT is
+    filled. Elements are freed as soon as they are read, so memory does not depend on the size of the file. """
+    string_tag, line_tag = f"{{{ALTO_NS}}}String", f"{{{ALTO_NS}}}TextLine"
+    for _, element in ET.iterparse(filepath, events=("end", ), tag=(string_tag, line_tag)):
+        if element.tag == string_tag:
+            content = element.get("CONTENT")
+            if content is not None:
+                yield bool(content)
+        else:
+            element.clear(keep_tail=True)
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+
+def _ends_with_alto(filepath: str) -> bool:
+    """ Cheap truncation check: reads the end of the file only and looks for the closing root element """
+    with open(filepath, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 256))
+        tail = f.read().rstrip()
+    return tail.endswith(b"alto>")
+
+
+def alto_content_stats(filepath: str) -> Optional[Tuple[int, int]]:
+    """ Counts the String elements of [FILEPATH] XML ALTO that have some CONTENT
+
+    :param filepath: ALTO file to check
+    :return: (Number of String with content, Number of String), None if the file could not be parsed
+    """
+    text_lines, lines = 0, 0
+    try:
+        for has_content in _iter_string_contents(filepath):
+            lines += 1
+            text_lines += has_content
+    except Exception:
+        return None
+    return text_lines, lines
+
+
+def content_ratio_reached(text_lines: int, lines: int, ratio: Union[int, float] = 1) -> bool:
+    """ Applies the threshold of `check_content` to the counts of `alto_content_stats`
+
+    >>> content_ratio_reached(0, 0)
+    True
+    >>> content_ratio_reached(1, 10, ratio=2)
+    False
+    >>> content_ratio_reached(8, 10, ratio=.8)
+    True
+    """
+    if lines == 0:  # The document has no lines
+        return True
+    elif isinstance(ratio, int):
+        return text_lines >= ratio
+    elif isinstance(ratio, float):
+        return (text_lines / (lines or 1)) >= ratio
+    return False
+
+
 def check_content(filepath, ratio: Union[int, float] = 1):
     """ Check that [FILEPATH] XML ALTO has at least [RATIO] content done. If [RATIO] is an int (ratio=2), check that it
         has at least [RATIO] lines (Here, >= 2). If [RATIO] is a float, check that it has
         `SUM(LINE WITH TEXT)/COUNT(LINES)` >= [RATIO]
 
+    The file is streamed and the check stops as soon as the result is decided: an int threshold is reached, or a
+    float threshold can no longer be reached (ratio >= 1 and a line without text). The remainder of the file is then
+    only checked for truncation, by looking for the closing `alto` tag.
+
     :param filepath: ALTO file to check
     :param ratio: Float (Percent) or Int (Absolute) threshold
     :return: True if the file has above N lines, False if it needs to be OCRized
     """
+    text_lines, lines = 0, 0
     try:
-        xml = ET.parse(filepath)
+        for has_content in _iter_string_contents(filepath):
+            lines += 1
+            text_lines += has_content
+            if isinstance(ratio, int):
+                if text_lines >= ratio:
+                    return _ends_with_alto(filepath)
+            elif isinstance(ratio, float):
+                if ratio <= 0:
+                    return _ends_with_alto(filepath)
+                elif not has_content and ratio >= 1:
+                    return False
     except Exception:
         return False
-    data = []
-    for content in xml.xpath("//a:String/@CONTENT", namespaces={"a": "http://www.loc.gov/standards/alto/ns-v4#"}):
-        data.append(int(bool(str(content))))
-    if len(data) == 0:  # The document has no lines
-        return True
-    elif isinstance(ratio, int):
-        return sum(data) >= ratio
-    elif isinstance(ratio, float):
-        return (sum(data) / (len(data) or 1)) >= ratio
-    return False
+    return content_ratio_reached(text_lines, lines, ratio=ratio)
 
 
 def clean_kraken_filename(filepath: str) -> Optional[str]:
@@ -182,6 +358,100 @@ def check_kraken_filename(filepath: str) -> bool:
     return True
 
 
+_XSLT_CACHE = threading.local()
+
+
+def get_xslt(path: str) -> ET.XSLT:
+    """ Compiles the XSLT at [PATH] once per thread, and thus once per worker process in process pools """
+    cache = getattr(_XSLT_CACHE, "xslts", None)
+    if cache is None:
+        cache = _XSLT_CACHE.xslts = {}
+    if path not in cache:
+        cache[path] = ET.XSLT(ET.parse(path))
+    return cache[path]
+
+
+def glyph_cleanup_xslt_path(keep_string: bool = True) -> str:
+    """ Path to the XSLT removing glyphs (and String elements if not [KEEP_STRING]) from ALTO """
+    return os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        ("clean-up-alto.xsl" if keep_string else "clean-up-alto-without-string.xsl")
+    )
+
+
+def _alto_status(xml, keep_string: bool = True) -> Dict[str, Union[bool, int]]:
+    ns = {"a": ALTO_NS}
+    contents = xml.xpath("//a:String/@CONTENT", namespaces=ns)
+    glyphs = xml.xpath("//a:Glyph" if keep_string else "//a:Glyph|//a:SP", namespaces=ns)
+    return {
+        "filename_fixed": not any(
+            "/" in (content.text or "")
+            for content in xml.xpath("//a:fileName", namespaces=ns)
+        ),
+        "glyphs_stripped": not glyphs,
+        "keep_string": keep_string,
+        "lines": len(contents),
+        "text_lines": sum(1 for content in contents if str(content))
+    }
+
+
+def alto_postprocess_status(filepath: str, keep_string: bool = True) -> Optional[Dict[str, Union[bool, int]]]:
+    """ Reports what `postprocess_alto` would find in [FILEPATH], without changing it
+
+    :param filepath: ALTO file to check
+    :param keep_string: Whether String elements are expected to be kept when glyphs are stripped
+    :returns: Dictionary with `filename_fixed`, `glyphs_stripped`, `keep_string`, `lines` and `text_lines` keys,
+        None if the file could not be parsed
+    """
+    try:
+        return _alto_status(ET.parse(filepath), keep_string=keep_string)
+    except Exception:
+        return None
+
+
+def postprocess_alto(
+        filepath: str,
+        strip_glyphs: bool = False,
+        keep_string: bool = True
+) -> Optional[Dict[str, Union[bool, int]]]:
+    """ Post-processes a Kraken ALTO file with a single parse and at most one atomic write: makes the image filename
+    relative to the file (See `clean_kraken_filename`), optionally removes glyphs with the clean-up XSLT and counts
+    the lines with text (See `alto_content_stats`).
+
+    :param filepath: File to correct
+    :param strip_glyphs: Apply the glyph clean-up XSLT
+    :param keep_string: Keeps the String elements when stripping glyphs
+    :returns: Same dictionary as `alto_postprocess_status` on the written file. None if it failed.
+    """
+    try:
+        xml = ET.parse(filepath)
+        changed = False
+        for content in xml.xpath("//a:fileName", namespaces={"a": ALTO_NS}):
+            if content.text and "/" in content.text:
+                content.text = os.path.basename(content.text)
+                changed = True
+        if strip_glyphs:
+            xml = get_xslt(glyph_cleanup_xslt_path(keep_string))(xml)
+        status = _alto_status(xml, keep_string=keep_string)
+    except Exception:
+        return None
+
+    if changed or strip_glyphs:
+        tmp = f"{filepath}.{os.getpid()}-{threading.get_ident()}.tmp"
+        try:
+            if strip_glyphs:
+                xml.write(tmp)
+            else:
+                with open(tmp, "w") as f:
+                    f.write(ET.tostring(xml, encoding=str))
+            os.replace(tmp, filepath)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return None
+    return status
+
+
 def batchify_textfile(filepath: str, batch_size: int = 100):
     """ Reads a list of file to process and batch them
 
@@ -257,7 +527,15 @@ def alto_zone_extraction(
     return out_text
 
 
-def pdf_extract(pdf_path: str, start_on: int = 0, scheme_string: Optional[str | Callable] = None) -> list[str]:
+def pdf_extract(
+        pdf_path: str,
+        start_on: int = 0,
+        scheme_string: Optional[str | Callable] = None,
+        dpi: int = 300,
+        colorspace: str = "rgb",
+        fmt: str = "jpg",
+        workers: int = 1
+) -> list[str]:
     """ Given a PDF file, generates a new folder with all extracted images
 
     Code adapted from Kraken 4.3.1
@@ -265,31 +543,32 @@ def pdf_extract(pdf_path: str, start_on: int = 0, scheme_string: Optional[str |
     :param pdf_path:
     :param start_on: Page to start on (Default is 2 because Gallica adds generated metadata)
     :param scheme_string: String Scheme
+    :param dpi: Resolution of the images
+    :param colorspace: Colour space of the images (rgb, gray)
+    :param fmt: Format of the images
+    :param workers: Number of processes rendering the pages (See `rtk.rasterize.PDFRasterizer`)
     :return:
     """
-    doc = fitz.open(pdf_path)
-    n_pages = len(doc)
     if not scheme_string:
-        scheme_string = pdf_name_scheme(pdf_path)
+        scheme_string = pdf_name_scheme(pdf_path, extension=fmt)
     elif callable(scheme_string):
         scheme_string = scheme_string(pdf_path)
-    out = []
-    for i in range(start_on, n_pages):
-        page = doc.load_page(i)
-        pix = page.get_pixmap(matrix=fitz.Matrix(300 / 72, 300 / 72)) # scaling dpi
-        local_targ = scheme_string.format(i)
-        pix.save(local_targ)
-        out.append(str(local_targ))
-    doc.close()
-    return out
+    rasterizer = PDFRasterizer(dpi=dpi, colorspace=colorspace, fmt=fmt, workers=workers)
+    return rasterizer.extract(pdf_path, scheme_string, start_on=start_on)
 
 
-def pdf_name_scheme(pdf_path: str, output_dir: Optional[str] = None, page_prefix: str = "f") -> str:
+def pdf_name_scheme(
+        pdf_path: str,
+        output_dir: Optional[str] = None,
+        page_prefix: str = "f",
+        extension: str = "jpg"
+) -> str:
     """ Generate a file scheme based on a PDF file
 
     :param pdf_path: Path to the PDF
     :param output_dir: Path where the output should be created, by default write in the same path as PDF
     :param page_prefix: The prefix for the file export, by default "f"
+    :param extension: Extension of the images, by default "jpg"
     :return: F-String
 
     >>> pdf_name_scheme("check.pdf")
@@ -302,6 +581,8 @@ def pdf_name_scheme(pdf_path: str, output_dir: Optional[str] = None, page_prefix
     'output/check/f{}.jpg'
     >>> pdf_name_scheme("check.pdf", page_prefix='p')
     'check/p{}.jpg'
+    >>> pdf_name_scheme("check.pdf", extension='png')
+    'check/f{}.png'
 
     """
     path = Path(pdf_path)
@@ -310,7 +591,7 @@ def pdf_name_scheme(pdf_path: str, output_dir: Optional[str] = None, page_prefix
     else:
         target = Path(os.path.join(path.parent, path.stem))
     os.makedirs(target, exist_ok=True)
-    return str(Path.joinpath(target, page_prefix + "{}.jpg"))
+    return str(Path.joinpath(target, page_prefix + "{}." + extension))
 
 
 def pdf_get_nb_pages(pdf_path: str) -> int:
@@ -343,7 +624,58 @@ def simple_args_kwargs_wrapper(function, **kwargs):
     return wrapped
 
 
-def cleverer_manifest_parsing(image: Dict[str, Any], head_check: bool = False) -> Optional[str]:
+class ServiceFormatCache:
+    """ Remembers how the images of a IIIF image service must be requested (without format, with the format of its
+    `info.json`, or through the resource URL), so that it is resolved once for all the canvases sharing the same
+    service profile on the same host instead of once per canvas. Thread safe: canvases resolved at the same time wait
+    for the first resolution of their service.
+    """
+    def __init__(self):
+        self._results: Dict[str, Optional[str]] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(service: Dict[str, Any]) -> str:
+        """ Service profile without the id of the image
+
+        >>> ServiceFormatCache.key({"@id": "https://a.org/iiif/1", "profile": "level2"})
+        'a.org {"profile": "level2"}'
+        """
+        profile = {k: v for k, v in service.items() if k not in {"@id", "id"}}
+        return f"{host_of(service.get('@id', service.get('id', '')))} {json.dumps(profile, sort_keys=True)}"
+
+    def resolve(self, service: Dict[str, Any], function: Callable[[], Optional[str]]) -> Optional[str]:
+        key = self.key(service)
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self._results:
+                self._results[key] = function()
+            return self._results[key]
+
+
+def _service_suffix(image: Dict[str, Any], image_url: str) -> Optional[str]:
+    """ Suffix of the image URLs of a service ('.jpg' when the image can be downloaded without format, the first format
+    of its profile otherwise), None when the resource URL must be used """
+    head_response = SESSIONS.head(image_url, allow_redirects=True, verify=True)
+    if head_response.status_code == 200:
+        return ".jpg"
+    # ... try get the format otherwise
+    response = SESSIONS.get(image['resource']['service']['@id'] + '/info.json', allow_redirects=True)
+    service_document = response.json()
+    if len(service_document['profile']) > 1:
+        service_profiles = service_document['profile'][1:]  # 0 is always a compliance URL
+        if 'formats' in service_profiles[0]:
+            return '.' + service_profiles[0]['formats'][0]  # just use the first format
+    return None
+
+
+def cleverer_manifest_parsing(
+        image: Dict[str, Any],
+        head_check: bool = False,
+        cache: Optional[ServiceFormatCache] = None
+) -> Optional[str]:
     """ More robust parsing of manifests that should handle most implementation of IIIF. Takes an image dict and
         returns a URL (None if could not be resolved)
 
@@ -351,6 +683,7 @@ def cleverer_manifest_parsing(image: Dict[str, Any], head_check: bool = False) -
 
     :param image:
     :param head_check: Runs a HEAD request on the image to check for extension (Defaults to NONE and JPG)
+    :param cache: Shares the result of the check between images of the same service profile
     :return:
     """
     if 'resource' in image and (('format' in image['resource'] and 'image' in image['resource']['format']) or
@@ -367,18 +700,13 @@ def cleverer_manifest_parsing(image: Dict[str, Any], head_check: bool = False) -
             image_url = image_url.replace('//full', '/full')
             # check if image can be downloaded without specifying the format...
             if head_check:
-                head_response = requests.head(image_url, allow_redirects=True, verify=True)
-                if head_response.status_code != 200:
-                    # ... try get the format otherwise
-                    response = requests.get(image['resource']['service']['@id'] + '/info.json', allow_redirects=True)
-                    service_document = response.json()
-                    if len(service_document['profile']) > 1:
-                        service_profiles = service_document['profile'][1:]  # 0 is always a compliance URL
-                        if 'formats' in service_profiles[0]:
-                            image_format = service_profiles[0]['formats'][0]  # just use the first format
-                            return image_url + '.' + image_format
-                        return image['resource']['@id']
+                if cache is None:
+                    suffix = _service_suffix(image, image_url)
+                else:
+                    suffix = cache.resolve(image['resource']['service'], partial(_service_suffix, image, image_url))
+                if suffix is None:
                     return image['resource']['@id']
+                return image_url + suffix
             return image_url+".jpg"
         return image['resource']['@id']
     return None
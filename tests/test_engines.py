@@ -0,0 +1,68 @@
+import os
+import time
+
+import pytest
+
+from rtk import engines
+from rtk.task import KrakenLikeCommand
+
+
+class FakeEngine(engines.Engine):
+    """ Writes an empty ALTO file, kills its worker on `crash` pages and fails the first attempt of `flaky` pages """
+    def load(self) -> None:
+        pass
+
+    def process_page(self, inp: str, out: str) -> None:
+        if "crash" in inp:
+            os._exit(1)
+        if "flaky" in inp and not os.path.exists(inp + ".tried"):
+            open(inp + ".tried", "w").close()
+            raise RuntimeError("Transient failure")
+        time.sleep(.3)  # Keeps the other pages in flight
+        with open(out, "w") as f:
+            f.write("<alto/>")
+
+
+def _init_worker(factory: engines.EngineFactory) -> None:
+    engines._ENGINE = factory()
+    engines._ENGINE.load()
+
+
+@pytest.fixture
+def fake_workers(monkeypatch):
+    # The worker initializer limits torch threads, which is not needed by the fake engine
+    monkeypatch.setattr(engines, "init_worker", _init_worker)
+
+
+def _run(tmp_path, names):
+    pages = []
+    for name in names:
+        page = tmp_path / f"{name}.jpg"
+        page.touch()
+        pages.append(str(page))
+    quarantine = tmp_path / "quarantine.txt"
+    task = KrakenLikeCommand(
+        pages,
+        command=["fake", "R"],
+        engine=True,
+        engine_factory=FakeEngine,
+        multiprocess=4,
+        quarantine=str(quarantine)
+    )
+    task.process()
+    quarantined = quarantine.read_text().split() if quarantine.exists() else []
+    return task, pages, quarantined
+
+
+def test_only_the_page_killing_the_worker_is_quarantined(tmp_path, fake_workers):
+    task, pages, quarantined = _run(tmp_path, ["p0", "crash", "p2", "p3", "p4", "p5"])
+    assert quarantined == [str(tmp_path / "crash.jpg")]
+    assert sorted(task.output_files) == sorted(
+        task.rename(page) for page in pages if page not in quarantined
+    )
+
+
+def test_transient_engine_failure_is_retried(tmp_path, fake_workers):
+    task, pages, quarantined = _run(tmp_path, ["p0", "flaky", "p2"])
+    assert quarantined == []
+    assert all(os.path.exists(task.rename(page)) for page in pages)
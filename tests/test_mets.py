@@ -0,0 +1,39 @@
+import zipfile
+
+from rtk import mets_utils
+from rtk.ledger import Ledger
+from rtk.task import AltoPostProcessCommand, METSBuilder
+
+
+ALTO = """<alto xmlns="http://www.loc.gov/standards/alto/ns-v4#"><Description><sourceImageInformation>
+<fileName>{image}</fileName></sourceImageInformation></Description><Layout><Page><PrintSpace><TextBlock><TextLine>
+<String CONTENT=""/></TextLine></TextBlock></PrintSpace></Page></Layout></alto>"""
+
+
+def test_image_names_come_from_the_ledger_after_the_alto_is_rewritten(tmp_path, monkeypatch):
+    book = tmp_path / "book"
+    book.mkdir()
+    ledger = Ledger(str(tmp_path / "ledger.sqlite"))
+    pages = []
+    for i in range(1, 4):
+        image, alto = book / f"book-f{i}.jpg", book / f"book-f{i}.xml"
+        image.write_bytes(b"jpg")
+        # Segmentation: Kraken writes the image path as it was given
+        alto.write_text(ALTO.format(image=str(image)))
+        ledger.record("YALTAiCommand", str(image), output=str(alto))
+        pages.append(str(alto))
+
+    # A later stage rewrites the ALTO files in place
+    AltoPostProcessCommand(pages, ledger=ledger).process()
+    assert not any(ledger.is_done(entry) for entry in ledger.entries("YALTAiCommand").values())
+
+    def alto_image_name(path):
+        raise AssertionError(f"{path} was opened")
+
+    monkeypatch.setattr(mets_utils, "alto_image_name", alto_image_name)
+    METSBuilder(pages, target_prefix=str(tmp_path / "mets"), backend="thread", ledger=ledger).process()
+
+    with zipfile.ZipFile(tmp_path / "mets" / "book-mets.zip") as archive:
+        mets = archive.read("METS.xml").decode()
+    for i in range(1, 4):
+        assert f'xlink:href="book-f{i}.jpg"' in mets